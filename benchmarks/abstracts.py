@@ -0,0 +1,96 @@
+"""Checks parse_abstract against recorded CrossRef abstracts and compares its speed with the BeautifulSoup parser.
+
+Every abstract in the fixture must parse to its recorded output, or the script exits with an error. The fixture
+covers the markup CrossRef abstracts come in: JATS paragraphs and sections, headings, inline markup, entities,
+abstracts without tags and broken markup. Abstracts can be added from a local CrossRef response cache with --record,
+after which their outputs should be reviewed by hand.
+
+    python -m benchmarks.abstracts
+    python -m benchmarks.abstracts --record 50 --cache-dir crossref_cache
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+
+from collect_documents import parse_abstract
+
+FIXTURE = os.path.join(os.path.dirname(__file__), "data", "crossref_abstracts.jsonl")
+
+
+def soup_parse_abstract(raw: str) -> str:
+    # The former parse_abstract, built on BeautifulSoup. Only reads the first paragraph
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup("<root>" + raw + "</root>", features="xml")
+    findp = soup.find('p')
+    if findp:
+        return findp.get_text()
+    return soup.find('jats:p').get_text()
+
+
+def record(fixture: list[dict], cache_dir: str, count: int) -> list[dict]:
+    # Adds abstracts from cached CrossRef pages of works that are not in the fixture yet
+    known = {sample["raw"] for sample in fixture}
+    added = []
+    for root, _, names in os.walk(cache_dir):
+        for name in names:
+            if len(added) >= count or not name.endswith(".json.gz"):
+                continue
+            with gzip.open(os.path.join(root, name), "rt", encoding="utf-8") as file:
+                entry = json.load(file)
+            for item in entry["message"].get("items", []):
+                raw = item.get("abstract")
+                if raw and raw not in known and len(added) < count:
+                    known.add(raw)
+                    added.append({"case": item.get("DOI", "recorded"), "raw": raw, "expected": parse_abstract(raw)})
+    return added
+
+
+def rate(parse, abstracts: list[str], repeat: int) -> tuple[float, int]:
+    # Abstracts per second and the number that raised
+    failures = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for raw in abstracts:
+            try:
+                parse(raw)
+            except Exception:
+                failures += 1
+    return len(abstracts) * repeat / (time.perf_counter() - start), failures // repeat
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--fixture", default=FIXTURE, help="JSON Lines file of raw abstracts and expected text.")
+    parser.add_argument("--repeat", type=int, default=200, help="Passes over the fixture when timing.")
+    parser.add_argument("--record", type=int, default=0, metavar="N",
+                        help="Add N abstracts from the response cache to the fixture with their current output.")
+    parser.add_argument("--cache-dir", default="crossref_cache", help="CrossRef response cache to record from.")
+    args = parser.parse_args()
+
+    with open(args.fixture, 'r', encoding='UTF-8') as file:
+        fixture = [json.loads(line) for line in file if line.strip()]
+
+    if args.record:
+        added = record(fixture, args.cache_dir, args.record)
+        with open(args.fixture, 'a', encoding='UTF-8') as file:
+            for sample in added:
+                file.write(json.dumps(sample, ensure_ascii=False) + "\n")
+        print(f"Recorded {len(added)} abstracts to {args.fixture}. Review their expected text before committing.")
+        fixture += added
+
+    mismatches = [(sample, parse_abstract(sample["raw"])) for sample in fixture
+                  if parse_abstract(sample["raw"]) != sample["expected"]]
+    for sample, actual in mismatches:
+        print(f"MISMATCH {sample['case']}\n  expected: {sample['expected']!r}\n  actual:   {actual!r}")
+    print(f"{len(fixture) - len(mismatches)} of {len(fixture)} abstracts match their recorded output.")
+
+    abstracts = [sample["raw"] for sample in fixture]
+    print(f"{'parser':<16} {'abstracts/s':>12} {'failures':>9}")
+    for name, parse in [("beautifulsoup", soup_parse_abstract), ("lxml", parse_abstract)]:
+        per_second, failures = rate(parse, abstracts, args.repeat)
+        print(f"{name:<16} {per_second:>12.1f} {failures:>9}")
+
+    sys.exit(1 if mismatches else 0)
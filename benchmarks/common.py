@@ -0,0 +1,29 @@
+"""Helpers shared by the benchmarks."""
+import os
+import sys
+
+from elasticsearch import Elasticsearch
+
+# The backend's modules live in local-be, which is not a package. Make them importable so that benchmarks send the
+# exact queries the backend sends. Appended, so the repository root's copy of a shared module such as encoders wins.
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "local-be"))
+
+
+def connect(host: str = None) -> Elasticsearch:
+    """Connects to Elasticsearch with the credentials in the environment or the repository's .env file."""
+    password = os.getenv("ELASTIC_PASSWORD")
+    if password is None and os.path.exists(".env"):
+        with open(".env", 'r') as f:
+            for line in f:
+                if line.startswith('ELASTIC_PASSWORD='):
+                    password = line.strip().split('=')[1]
+                    break
+
+    es = Elasticsearch(host or "http://localhost:9200", basic_auth=("elastic", password), request_timeout=600)
+    es.info()
+    return es
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    """Gets the p-th percentile of already sorted values by the nearest-rank method."""
+    return sorted_values[min(int(p / 100 * len(sorted_values)), len(sorted_values) - 1)]
@@ -0,0 +1,56 @@
+"""Measures how embedding throughput scales with the number of worker processes in the ingest's embedding pool.
+
+Sentences go through collect_documents.embed_documents, as during ingest, once in process and once per pool size.
+Speedup and efficiency are relative to the single process run.
+
+    python -m benchmarks.embedding_pool --workers 1 2 4 8 --threads 4 --pin-cores
+"""
+import argparse
+import time
+
+from benchmarks.search_concurrency import DEFAULT_QUERIES
+from collect_documents import embed_documents, get_model
+from embedding_pool import EmbeddingPool
+
+
+def run(sentences: list[str], per_paper: int, batch_size: int, pool: EmbeddingPool = None) -> float:
+    # Embeds every sentence, grouped into papers, and returns sentences per second
+    papers = [({"DOI": str(i)}, sentences[i:i + per_paper]) for i in range(0, len(sentences), per_paper)]
+    start = time.perf_counter()
+    count = sum(len(doc["embedded_paper"]) for doc in embed_documents(papers, batch_size, pool=pool))
+    return count / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8], help="Pool sizes to measure.")
+    parser.add_argument("--threads", type=int, help="Threads per worker. Defaults to the cores divided by workers.")
+    parser.add_argument("--pin-cores", action="store_true", help="Bind each worker to its own block of cores.")
+    parser.add_argument("--sentences", help="File with one sentence per line. Defaults to a built-in set.")
+    parser.add_argument("--repeat", type=int, default=20000,
+                        help="Number of sentences to encode when using the built-in set.")
+    parser.add_argument("--batch-size", type=int, default=256, help="Sentences per encode call.")
+    parser.add_argument("--per-paper", type=int, default=8, help="Sentences grouped into each paper.")
+    args = parser.parse_args()
+
+    if args.sentences:
+        with open(args.sentences, 'r', encoding='UTF-8') as file:
+            sentences = [line.strip() for line in file if line.strip()]
+    else:
+        sentences = [f"{DEFAULT_QUERIES[i % len(DEFAULT_QUERIES)]} in study {i}" for i in range(args.repeat)]
+    warmup = sentences[:args.batch_size]
+
+    get_model().encode(warmup, batch_size=len(warmup))
+    results = [("in process", 1, run(sentences, args.per_paper, args.batch_size))]
+    for workers in args.workers:
+        with EmbeddingPool(workers, args.threads, args.pin_cores) as pool:
+            # Load the model in every worker before timing
+            for future in [pool.submit(warmup) for _ in range(workers * 2)]:
+                future.result()
+            results.append((f"{workers} x {pool.threads} threads", workers,
+                            run(sentences, args.per_paper, args.batch_size, pool)))
+
+    baseline = results[0][2]
+    print(f"{'embedding':<22} {'sent/s':>9} {'speedup':>8} {'efficiency':>11}")
+    for name, workers, rate in results:
+        print(f"{name:<22} {rate:>9.1f} {rate / baseline:>8.2f} {rate / baseline / workers:>11.0%}")
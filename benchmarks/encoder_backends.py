@@ -0,0 +1,86 @@
+"""Compares encoder backends on throughput, per-query latency, memory and agreement with PyTorch.
+
+Every backend runs in its own process so that its peak memory can be measured on its own. Agreement is the cosine
+similarity between each sentence's vector and the PyTorch fp32 vector of the same sentence.
+
+    python -m benchmarks.encoder_backends --backends torch onnx onnx:avx512_vnni --sentences sentences.txt
+"""
+import argparse
+import multiprocessing
+import resource
+import statistics
+import time
+
+import numpy as np
+
+from benchmarks.search_concurrency import DEFAULT_QUERIES
+
+
+def measure(spec: str, sentences: list[str], batch_size: int, queries: int, threads: int) -> dict:
+    # Runs in a child process. spec is "torch", "onnx" or "onnx:<quantization config>"
+    import torch
+    torch.set_num_threads(threads)
+    from encoders import load_encoder
+
+    backend, _, quantize = spec.partition(":")
+    start = time.perf_counter()
+    model = load_encoder(backend, quantize or "none")
+    load_seconds = time.perf_counter() - start
+
+    model.encode(sentences[:batch_size], batch_size=batch_size)  # Warm up
+
+    start = time.perf_counter()
+    embeddings = model.encode(sentences, batch_size=batch_size, normalize_embeddings=True)
+    throughput = len(sentences) / (time.perf_counter() - start)
+
+    latencies = []
+    for i in range(queries):
+        start = time.perf_counter()
+        model.encode(sentences[i % len(sentences)])
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+
+    return {
+        "backend": spec,
+        "load_s": load_seconds,
+        "sentences_per_s": throughput,
+        "p50_ms": statistics.median(latencies),
+        "p95_ms": latencies[int(0.95 * (len(latencies) - 1))],
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "embeddings": embeddings,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backends", nargs="+", default=["torch", "onnx", "onnx:avx2", "onnx:avx512_vnni"],
+                        help="Backends to compare: torch, onnx, or onnx:<quantization config>.")
+    parser.add_argument("--sentences", help="File with one sentence per line. Defaults to a built-in set.")
+    parser.add_argument("--repeat", type=int, default=1000,
+                        help="Number of sentences to encode when using the built-in set.")
+    parser.add_argument("--batch-size", type=int, default=256, help="Sentences per encode call.")
+    parser.add_argument("--queries", type=int, default=200, help="Single-query encodes timed for latency.")
+    parser.add_argument("--threads", type=int, default=4, help="Torch intra-op threads per backend.")
+    args = parser.parse_args()
+
+    if args.sentences:
+        with open(args.sentences, 'r', encoding='UTF-8') as file:
+            sentences = [line.strip() for line in file if line.strip()]
+    else:
+        sentences = [f"{DEFAULT_QUERIES[i % len(DEFAULT_QUERIES)]} in study {i}" for i in range(args.repeat)]
+
+    # A fresh process per backend, so that peak memory is not shared between them
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for spec in args.backends:
+        with context.Pool(1) as pool:
+            results.append(pool.apply(measure, (spec, sentences, args.batch_size, args.queries, args.threads)))
+
+    reference = next((r["embeddings"] for r in results if r["backend"] == "torch"), results[0]["embeddings"])
+    print(f"{'backend':<20} {'load s':>7} {'sent/s':>9} {'p50 ms':>7} {'p95 ms':>7} {'rss MiB':>8} "
+          f"{'cos mean':>9} {'cos min':>8}")
+    for r in results:
+        cosine = np.sum(r["embeddings"] * reference, axis=1)
+        print(f"{r['backend']:<20} {r['load_s']:>7.1f} {r['sentences_per_s']:>9.1f} {r['p50_ms']:>7.2f} "
+              f"{r['p95_ms']:>7.2f} {r['peak_rss_mb']:>8.0f} {cosine.mean():>9.5f} {cosine.min():>8.5f}")
@@ -0,0 +1,103 @@
+"""Reports index size and recall of quantized vector index options against full precision vectors.
+
+Copies a sample of papers from an existing index into one new index per option, plus an exact float32 "flat" index
+as ground truth. Random sentence vectors from the sample are used as queries, so no model is needed. Recall@k is
+the share of the exact top-k papers that each option also returns.
+
+    python -m benchmarks.index_options --source research_papers --docs 5000 --types hnsw int8_hnsw int4_hnsw bbq_hnsw
+"""
+import argparse
+import random
+import time
+
+from elasticsearch import helpers
+
+from benchmarks.common import connect, percentile
+from collect_documents import VECTOR_INDEX_TYPES, elasticsearch_mappings
+
+DIMS = 384
+
+
+def estimated_memory(index_type: str, vectors: int, m: int) -> float:
+    # Off-heap memory needed to search the vectors, per Elasticsearch's sizing guidance
+    if index_type.startswith("int8"):
+        size = vectors * (DIMS + 4)
+    elif index_type.startswith("int4"):
+        size = vectors * (DIMS / 2 + 4)
+    elif index_type.startswith("bbq"):
+        size = vectors * (DIMS / 8 + 14)
+    else:
+        size = vectors * 4 * DIMS
+    if index_type.endswith("hnsw"):
+        size += vectors * 4 * m
+    return size
+
+
+def search(es, index: str, vector: list[float], k: int, num_candidates: int) -> tuple[list[str], float]:
+    start = time.perf_counter()
+    response = es.search(index=index, knn={"field": "embedded_paper.vector", "query_vector": vector, "k": k,
+                                           "num_candidates": num_candidates}, source=False, size=k)
+    return [hit["_id"] for hit in response["hits"]["hits"]], (time.perf_counter() - start) * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="http://localhost:9200")
+    parser.add_argument("--source", default="research_papers", help="Index to sample papers from.")
+    parser.add_argument("--docs", type=int, default=5000, help="Number of papers to sample.")
+    parser.add_argument("--types", nargs="+", default=["hnsw", "int8_hnsw", "int4_hnsw", "bbq_hnsw"],
+                        choices=VECTOR_INDEX_TYPES, help="Index options to compare.")
+    parser.add_argument("--m", type=int, default=16)
+    parser.add_argument("--ef-construction", type=int, default=100)
+    parser.add_argument("--queries", type=int, default=200, help="Number of query vectors.")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--num-candidates", type=int, default=100)
+    parser.add_argument("--keep", action="store_true", help="Keep the benchmark indices afterwards.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    es = connect(args.host)
+
+    print(f"Sampling {args.docs} papers from {args.source}...")
+    sample = []
+    for hit in helpers.scan(es, index=args.source, size=200):
+        sample.append((hit["_id"], hit["_source"]))
+        if len(sample) >= args.docs:
+            break
+    vectors = [e["vector"] for _, doc in sample for e in doc["embedded_paper"]]
+    queries = random.Random(args.seed).sample(vectors, min(args.queries, len(vectors)))
+
+    results = {}
+    for index_type in ["flat"] + [t for t in args.types if t != "flat"]:
+        index = f"bench_vectors_{index_type}"
+        es.options(ignore_status=404).indices.delete(index=index)
+        es.indices.create(index=index, body=elasticsearch_mappings(index_type, args.m, args.ef_construction))
+
+        start = time.perf_counter()
+        helpers.bulk(es, ({"_index": index, "_id": _id, "_source": doc} for _id, doc in sample),
+                     chunk_size=100, max_chunk_bytes=10 * 1024 ** 2)
+        es.indices.refresh(index=index)
+        es.indices.forcemerge(index=index, max_num_segments=1)
+        build_seconds = time.perf_counter() - start
+
+        store = es.indices.stats(index=index, metric="store")["indices"][index]["total"]["store"]["size_in_bytes"]
+        hits, latencies = [], []
+        for vector in queries:
+            ids, ms = search(es, index, vector, args.k, args.num_candidates)
+            hits.append(ids)
+            latencies.append(ms)
+        results[index_type] = (build_seconds, store, hits, sorted(latencies))
+
+        if not args.keep:
+            es.indices.delete(index=index)
+
+    exact = results["flat"][2]
+    print(f"{len(sample)} papers, {len(vectors)} vectors, {len(queries)} queries, k={args.k}, "
+          f"num_candidates={args.num_candidates}, m={args.m}, ef_construction={args.ef_construction}")
+    print(f"{'index type':<12} {'build s':>8} {'disk MiB':>9} {'vector RAM MiB':>15} {f'recall@{args.k}':>10} "
+          f"{'p50 ms':>7} {'p95 ms':>7}")
+    for index_type, (build_seconds, store, hits, latencies) in results.items():
+        recall = sum(len(set(h) & set(e)) / max(len(e), 1) for h, e in zip(hits, exact)) / len(exact)
+        memory = estimated_memory(index_type, len(vectors), args.m) / 1024 ** 2
+        print(f"{index_type:<12} {build_seconds:>8.1f} {store / 1024 ** 2:>9.1f} {memory:>15.1f} {recall:>10.4f} "
+              f"{percentile(latencies, 50):>7.2f} {percentile(latencies, 95):>7.2f}")
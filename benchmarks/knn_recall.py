@@ -0,0 +1,107 @@
+"""Sweeps kNN search parameters and reports recall@k against exact search, with latency and throughput.
+
+Ground truth is computed exactly with NumPy from the vector shards the indices were built from, for example with
+`uploader.py --export-shards`. Each index can be built with different index options, see benchmarks.index_options
+with --keep. For every index, k and num_candidates, the query set is replayed against Elasticsearch. Recall@k is the
+share of the exact top-k results that were returned: papers in the nested layout, sentences in the flat layout.
+
+    python -m benchmarks.knn_recall --shards collected --indices research_papers --queries claims.txt \
+        --k 10 50 100 --num-candidates 50 100 200 500 1000
+"""
+import argparse
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from benchmarks.common import connect, percentile
+from numpy_search import NumpySearch
+from query import knn_query, search_results
+from shards import load_vectors, read_manifest
+
+
+def result_key(result: dict[str], layout: str):
+    # Papers are the unit of a nested search, sentences of a flat one
+    return result["doi"] if layout == "nested" else (result["doi"], result["sentence"])
+
+
+def run(es, index: str, layout: str, vectors: np.ndarray, k: int, num_candidates: int,
+        concurrency: int) -> tuple[list[list[dict[str]]], list[float], list[float], float]:
+    def one(vector):
+        body = knn_query(vector.tolist(), k, layout)
+        body["knn"]["num_candidates"] = num_candidates
+        start = time.perf_counter()
+        response = es.search(index=index, body=body)
+        return search_results(response, layout), (time.perf_counter() - start) * 1000, response["took"]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        outcomes = list(executor.map(one, vectors))
+    elapsed = time.perf_counter() - start
+    results, latencies, took = zip(*outcomes)
+    return list(results), sorted(latencies), sorted(took), len(vectors) / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="http://localhost:9200")
+    parser.add_argument("--shards", default="collected", help="Vector shards the indices were built from.")
+    parser.add_argument("--indices", nargs="+", default=["research_papers"], help="Indices to compare.")
+    parser.add_argument("--layout", default="nested", choices=["nested", "flat"], help="Layout of the indices.")
+    parser.add_argument("--queries", help="File with one query per line, embedded with the configured encoder. "
+                                          "Without it, random stored sentence vectors are used as queries.")
+    parser.add_argument("--sample", type=int, default=500, help="Number of stored vectors used as queries.")
+    parser.add_argument("--k", type=int, nargs="+", default=[10, 50, 100])
+    parser.add_argument("--num-candidates", type=int, nargs="+", default=[50, 100, 200, 500, 1000])
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="Searches in flight. 1 gives clean latencies, more measures throughput under load.")
+    parser.add_argument("--output", help="Also write every measurement to this JSON file.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.queries:
+        from encoders import load_encoder
+        with open(args.queries, 'r', encoding='UTF-8') as file:
+            texts = [line.strip() for line in file if line.strip()]
+        vectors = load_encoder().encode(texts, normalize_embeddings=True)
+    else:
+        stored = np.concatenate([load_vectors(args.shards, s["name"]) for s in read_manifest(args.shards)["shards"]])
+        rows = random.Random(args.seed).sample(range(len(stored)), min(args.sample, len(stored)))
+        vectors = np.asarray(stored[sorted(rows)], dtype=np.float32)
+
+    print(f"Computing exact top-{max(args.k)} of {len(vectors)} queries...")
+    engine = NumpySearch(args.shards)
+    exact = engine.search(vectors, max(args.k), per_paper=args.layout == "nested")
+
+    es = connect(args.host)
+    measurements = []
+    print(f"{'index':<24} {'k':>5} {'cands':>6} {'recall':>7} {'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7} "
+          f"{'took p50':>9} {'qps':>7}")
+    for index in args.indices:
+        # Warm up the index before measuring
+        run(es, index, args.layout, vectors[:10], min(args.k), max(min(args.k), 10), 1)
+        for k in args.k:
+            truth = [{result_key(r, args.layout) for r in e[:k]} for e in exact]
+            for num_candidates in args.num_candidates:
+                if num_candidates < k:
+                    continue
+                results, latencies, took, qps = run(es, index, args.layout, vectors, k, num_candidates,
+                                                     args.concurrency)
+                recall = np.mean([len({result_key(r, args.layout) for r in found} & t) / max(len(t), 1)
+                                  for found, t in zip(results, truth)])
+                measurement = {
+                    "index": index, "k": k, "num_candidates": num_candidates, "recall": float(recall),
+                    "p50_ms": percentile(latencies, 50), "p95_ms": percentile(latencies, 95),
+                    "p99_ms": percentile(latencies, 99), "took_p50_ms": percentile(took, 50), "qps": qps
+                }
+                measurements.append(measurement)
+                print(f"{index:<24} {k:>5} {num_candidates:>6} {recall:>7.4f} {measurement['p50_ms']:>7.2f} "
+                      f"{measurement['p95_ms']:>7.2f} {measurement['p99_ms']:>7.2f} "
+                      f"{measurement['took_p50_ms']:>9.1f} {qps:>7.1f}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='UTF-8') as file:
+            json.dump({"queries": len(vectors), "layout": args.layout, "concurrency": args.concurrency,
+                       "measurements": measurements}, file, indent=2)
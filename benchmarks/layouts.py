@@ -0,0 +1,106 @@
+"""Compares the nested and flat index layouts on bulk throughput, index size and query latency.
+
+Copies a sample of papers from an existing nested index into a fresh index of each layout with the uploader's bulk
+indexer. Random sentence vectors from the sample are used as queries, so no model is needed.
+
+    python -m benchmarks.layouts --source research_papers --docs 5000 --queries 500 --k 10
+"""
+import argparse
+import json
+import random
+import time
+
+from elasticsearch import helpers
+
+from benchmarks.common import connect, percentile
+from bulk_indexer import bulk_index
+from collect_documents import elasticsearch_mappings, flatten_document, paper_mappings, sentence_mappings
+from query import knn_query, search_results
+
+
+def nested_actions(sample, index):
+    for doc in sample:
+        yield {"index": {"_index": index}}, doc
+
+
+def flat_actions(sample, papers_index, sentences_index):
+    for doc in sample:
+        doi = doc["metadata"]["DOI"]
+        yield {"index": {"_index": papers_index, "_id": doi}}, {"metadata": doc["metadata"]}
+        for sentence in flatten_document(doc):
+            yield {"index": {"_index": sentences_index, "_id": f"{doi}/{sentence['position']}"}}, sentence
+
+
+def store_size(es, indices: list[str]) -> int:
+    stats = es.indices.stats(index=",".join(indices), metric="store")["indices"]
+    return sum(stats[i]["total"]["store"]["size_in_bytes"] for i in indices)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="http://localhost:9200")
+    parser.add_argument("--source", default="research_papers", help="Nested index to sample papers from.")
+    parser.add_argument("--docs", type=int, default=5000, help="Number of papers to sample.")
+    parser.add_argument("--index-type", default="int8_hnsw")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--bulk-workers", type=int, default=4)
+    parser.add_argument("--keep", action="store_true", help="Keep the benchmark indices afterwards.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    es = connect(args.host)
+
+    print(f"Sampling {args.docs} papers from {args.source}...")
+    sample = []
+    for hit in helpers.scan(es, index=args.source, size=200):
+        sample.append(hit["_source"])
+        if len(sample) >= args.docs:
+            break
+    vectors = [e["vector"] for doc in sample for e in doc["embedded_paper"]]
+    queries = random.Random(args.seed).sample(vectors, min(args.queries, len(vectors)))
+    payload = sum(len(json.dumps(doc)) for doc in sample)
+
+    layouts = {
+        "nested": ({"bench_layout_nested": elasticsearch_mappings(args.index_type)},
+                   lambda: nested_actions(sample, "bench_layout_nested"), "bench_layout_nested"),
+        "flat": ({"bench_layout_sentences": sentence_mappings(args.index_type),
+                  "bench_layout_papers": paper_mappings()},
+                 lambda: flat_actions(sample, "bench_layout_papers", "bench_layout_sentences"),
+                 "bench_layout_sentences"),
+    }
+
+    print(f"{len(sample)} papers, {len(vectors)} sentences, {payload / 1024 ** 2:.1f} MiB of JSON, "
+          f"{len(queries)} queries, k={args.k}")
+    print(f"{'layout':<8} {'papers/s':>9} {'MiB/s':>7} {'disk MiB':>9} {'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7} "
+          f"{'sentences/paper':>16}")
+    for layout, (indices, actions, search_index) in layouts.items():
+        for name, mappings in indices.items():
+            es.options(ignore_status=404).indices.delete(index=name)
+            es.indices.create(index=name, body=mappings)
+
+        start = time.perf_counter()
+        failed = sum(not ok for ok, _, _ in bulk_index(es, actions(), workers=args.bulk_workers))
+        es.indices.refresh(index=",".join(indices))
+        bulk_seconds = time.perf_counter() - start
+        if failed:
+            print(f"{layout}: {failed} documents failed to index")
+
+        es.indices.forcemerge(index=",".join(indices), max_num_segments=1)
+        size = store_size(es, list(indices))
+
+        latencies, distinct = [], []
+        for vector in queries:
+            start = time.perf_counter()
+            response = es.search(index=search_index, body=knn_query(vector, args.k, layout))
+            latencies.append((time.perf_counter() - start) * 1000)
+            results = search_results(response, layout)
+            distinct.append(len(results) / max(len({r["doi"] for r in results}), 1))
+        latencies.sort()
+
+        print(f"{layout:<8} {len(sample) / bulk_seconds:>9.1f} {payload / 1024 ** 2 / bulk_seconds:>7.1f} "
+              f"{size / 1024 ** 2:>9.1f} {percentile(latencies, 50):>7.2f} {percentile(latencies, 95):>7.2f} "
+              f"{percentile(latencies, 99):>7.2f} {sum(distinct) / len(distinct):>16.2f}")
+
+        if not args.keep:
+            es.indices.delete(index=",".join(indices))
@@ -0,0 +1,85 @@
+"""Measures how /search/vector throughput scales with the number of requests in flight.
+
+Sends the same set of queries at increasing concurrency levels and reports throughput and latency percentiles
+for each level. Only the standard library is used, so it runs from any machine that can reach the backend.
+
+    python -m benchmarks.search_concurrency --url http://localhost:8000 --levels 1 2 4 8 16 32
+"""
+import argparse
+import json
+import statistics
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_QUERIES = [
+    "Sugar consumption causes tooth decay",
+    "Coffee reduces the risk of type 2 diabetes",
+    "Red meat increases the risk of colorectal cancer",
+    "Probiotics improve gut health",
+    "Vitamin D supplements prevent respiratory infections",
+    "Intermittent fasting leads to weight loss",
+    "Organic food contains more nutrients",
+    "Dietary fiber lowers cholesterol",
+]
+
+
+def search(url: str, text: str, top_k: int) -> float:
+    # Send one search and return its latency in seconds
+    body = json.dumps({"text": text, "top_k": top_k}).encode("utf-8")
+    request = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"})
+    start = time.perf_counter()
+    with urllib.request.urlopen(request) as response:
+        response.read()
+    return time.perf_counter() - start
+
+
+def run_level(url: str, queries: list[str], concurrency: int, requests_per_level: int, top_k: int) -> dict:
+    texts = [queries[i % len(queries)] for i in range(requests_per_level)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        latencies = sorted(executor.map(lambda t: search(url, t, top_k), texts))
+    elapsed = time.perf_counter() - start
+
+    def percentile(p):
+        return latencies[min(int(p / 100 * len(latencies)), len(latencies) - 1)] * 1000
+
+    return {
+        "concurrency": concurrency,
+        "throughput": len(latencies) / elapsed,
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "p50_ms": percentile(50),
+        "p95_ms": percentile(95),
+        "p99_ms": percentile(99),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:8000", help="Base URL of the backend.")
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32],
+                        help="Numbers of requests in flight to measure.")
+    parser.add_argument("--requests", type=int, default=200, help="Requests sent per concurrency level.")
+    parser.add_argument("--top-k", type=int, default=10, help="top_k of every search.")
+    parser.add_argument("--queries", help="File with one query per line. Defaults to a built-in set.")
+    parser.add_argument("--unique", action="store_true",
+                        help="Make every query unique so that the query embedding cache never hits.")
+    args = parser.parse_args()
+
+    queries = DEFAULT_QUERIES
+    if args.queries:
+        with open(args.queries, 'r', encoding='UTF-8') as file:
+            queries = [line.strip() for line in file if line.strip()]
+
+    endpoint = args.url.rstrip("/") + "/search/vector"
+    # Warm up the model and connections before measuring
+    search(endpoint, queries[0], args.top_k)
+
+    print(f"{'in flight':>9} {'req/s':>8} {'mean ms':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for level in args.levels:
+        level_queries = queries
+        if args.unique:
+            level_queries = [f"{queries[i % len(queries)]} ({level}-{i})" for i in range(args.requests)]
+        result = run_level(endpoint, level_queries, level, args.requests, args.top_k)
+        print(f"{result['concurrency']:>9} {result['throughput']:>8.1f} {result['mean_ms']:>8.1f} "
+              f"{result['p50_ms']:>8.1f} {result['p95_ms']:>8.1f} {result['p99_ms']:>8.1f}")
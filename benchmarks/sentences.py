@@ -0,0 +1,68 @@
+"""Compares ways of splitting abstracts into sentences with spaCy, in abstracts per second.
+
+- per call: a new pipeline for every abstract, as separate_sentences used to build.
+- reused: one pipeline called on each abstract in turn, as separate_sentences does now.
+- pipe: abstracts streamed through the reused pipeline in batches with split_sentences, as get_documents does.
+- pipe xN: the same spread over N processes.
+
+    python -m benchmarks.sentences --abstracts abstracts.txt --processes 2 4
+"""
+import argparse
+import time
+
+from spacy.lang.en import English
+
+from benchmarks.search_concurrency import DEFAULT_QUERIES
+from collect_documents import get_sentencizer, separate_sentences, split_sentences
+
+
+def per_call(abstract: str) -> list[str]:
+    # The former separate_sentences, which built the pipeline on every call
+    nlp = English()
+    nlp.add_pipe("sentencizer")
+    return [sent.text.strip() for sent in nlp(abstract).sents]
+
+
+def rate(split, abstracts: list[str]) -> tuple[float, list[list[str]]]:
+    start = time.perf_counter()
+    sentences = split(abstracts)
+    return len(abstracts) / (time.perf_counter() - start), sentences
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--abstracts", help="File with one plaintext abstract per line. Defaults to a built-in set.")
+    parser.add_argument("--repeat", type=int, default=5000,
+                        help="Number of abstracts to split when using the built-in set.")
+    parser.add_argument("--per-call", type=int, default=200,
+                        help="Number of abstracts to split with a new pipeline per call, which is far slower.")
+    parser.add_argument("--batch-size", type=int, default=64, help="Abstracts per batch given to spaCy.")
+    parser.add_argument("--processes", type=int, nargs="*", default=[2, 4],
+                        help="Process counts to measure streaming with.")
+    args = parser.parse_args()
+
+    if args.abstracts:
+        with open(args.abstracts, 'r', encoding='UTF-8') as file:
+            abstracts = [line.strip() for line in file if line.strip()]
+    else:
+        abstracts = [" ".join(f"{DEFAULT_QUERIES[(i + j) % len(DEFAULT_QUERIES)].capitalize()} in study {i}."
+                              for j in range(8)) for i in range(args.repeat)]
+
+    get_sentencizer()
+    runs = [
+        ("per call", lambda texts: [per_call(t) for t in texts]),
+        ("reused", lambda texts: [separate_sentences(t) for t in texts]),
+        ("pipe", lambda texts: [s for s, _ in split_sentences(((t, None) for t in texts), args.batch_size)]),
+    ]
+    for n in args.processes:
+        runs.append((f"pipe x{n}", lambda texts, n=n: [s for s, _ in split_sentences(((t, None) for t in texts),
+                                                                                     args.batch_size, n)]))
+
+    # Starting worker processes takes seconds, so streaming over processes only pays off on many abstracts
+    results = [(name, *rate(split, abstracts[:args.per_call] if name == "per call" else abstracts))
+               for name, split in runs]
+    baseline, expected = results[0][1], results[0][2]
+    print(f"{'splitting':<12} {'abstracts/s':>12} {'speedup':>8} {'same output':>12}")
+    for name, per_second, sentences in results:
+        same = sentences[:len(expected)] == expected
+        print(f"{name:<12} {per_second:>12.1f} {per_second / baseline:>8.2f} {str(same):>12}")
@@ -0,0 +1,118 @@
+import json
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Iterable, Iterator
+
+from elasticsearch import ApiError, ConnectionError, ConnectionTimeout, Elasticsearch
+
+from profiler import Profiler
+
+
+def _chunks(actions: Iterable[tuple[dict[str], dict[str]]], chunk_docs: int,
+            chunk_bytes: int) -> Iterator[list[tuple[bytes, dict[str]]]]:
+    # Group serialized actions into chunks limited by both number of documents and request size
+    chunk = []
+    size = 0
+    for action, source in actions:
+        data = (json.dumps(action) + "\n" + json.dumps(source) + "\n").encode("utf-8")
+        if chunk and (len(chunk) >= chunk_docs or size + len(data) > chunk_bytes):
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append((data, source))
+        size += len(data)
+
+    if chunk:
+        yield chunk
+
+
+def _send(es: Elasticsearch, chunk: list[tuple[bytes, dict[str]]], max_retries: int, initial_backoff: float,
+          profiler: Profiler = None) -> list[tuple[bool, dict[str], dict[str]]]:
+    # Send one chunk, timed with its retries as the "upload" stage
+    if profiler is None:
+        return _send_chunk(es, chunk, max_retries, initial_backoff)
+    with profiler.stage("upload", documents=len(chunk), bytes=sum(len(data) for data, _ in chunk)):
+        return _send_chunk(es, chunk, max_retries, initial_backoff)
+
+
+def _send_chunk(es: Elasticsearch, chunk: list[tuple[bytes, dict[str]]], max_retries: int,
+                initial_backoff: float) -> list[tuple[bool, dict[str], dict[str]]]:
+    # Send one chunk, retrying only the items Elasticsearch rejected for being overloaded
+    results = []
+    for attempt in range(max_retries + 1):
+        try:
+            response = es.bulk(operations=b"".join(data for data, _ in chunk))
+        except (ConnectionError, ConnectionTimeout, ApiError) as e:
+            # The whole request failed. Retry it as is unless it was refused for a reason retrying won't fix
+            status = e.status_code if isinstance(e, ApiError) else None
+            if attempt == max_retries or status not in (None, 429, 502, 503, 504):
+                return results + [(False, source, {"error": str(e), "status": status}) for _, source in chunk]
+            time.sleep(initial_backoff * 2 ** attempt)
+            continue
+
+        retry = []
+        for (data, source), item in zip(chunk, response["items"]):
+            info = next(iter(item.values()))
+            if "error" not in info:
+                results.append((True, source, info))
+            elif info.get("status") == 429 and attempt < max_retries:
+                retry.append((data, source))
+            else:
+                results.append((False, source, info))
+
+        if not retry:
+            return results
+        chunk = retry
+        time.sleep(initial_backoff * 2 ** attempt)
+
+    return results
+
+
+def bulk_index(es: Elasticsearch, actions: Iterable[tuple[dict[str], dict[str]]], chunk_docs: int = 500,
+               chunk_bytes: int = 10 * 1024 ** 2, workers: int = 4, max_retries: int = 3,
+               initial_backoff: float = 2.0, profiler: Profiler = None) -> Iterator[tuple[bool, dict[str], dict[str]]]:
+    """Indexes documents through concurrent bulk requests and reports the outcome of every document.
+
+    Chunks are limited by both number of documents and size in bytes, since documents with many sentence vectors
+    are far larger than others. Up to `workers` chunks are sent at once while the caller's iterator keeps
+    producing documents, so embedding and uploading overlap. Items rejected with 429 are retried with
+    exponential backoff.
+
+    Parameters
+    ----------
+    es : Elasticsearch
+        Client to send bulk requests with.
+    actions : Iterable of tuple
+        Pairs of bulk action metadata, such as {"index": {"_index": name}}, and the document source.
+    chunk_docs : int
+        Maximum number of documents per bulk request.
+    chunk_bytes : int
+        Maximum size in bytes of a bulk request body. A single larger document is still sent on its own.
+    workers : int
+        Number of bulk requests in flight at once.
+    max_retries : int
+        Number of times a rejected item or failed request is retried.
+    initial_backoff : float
+        Seconds to wait before the first retry. Doubles on every retry.
+    profiler : Profiler, optional
+        Profiler to record every bulk request, retries included, in as the "upload" stage.
+
+    Yields
+    ------
+    tuple of bool, dict of str, dict of str
+        Whether the document was indexed, its source, and the bulk response item or error for it.
+    """
+    with ThreadPoolExecutor(workers) as executor:
+        in_flight = set()
+        for chunk in _chunks(actions, chunk_docs, chunk_bytes):
+            # Keep a bounded number of chunks waiting so memory stays flat when Elasticsearch is slow
+            while len(in_flight) >= workers * 2:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+            in_flight.add(executor.submit(_send, es, chunk, max_retries, initial_backoff, profiler))
+
+        while in_flight:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield from future.result()
@@ -0,0 +1,149 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+
+
+class Checkpoint:
+    """Progress of an ingest run that can be saved to disk and resumed from.
+
+    Tracks the DOIs that have been indexed, the journals that are finished, and for every journal still in
+    progress the cursor of its oldest page that still has papers waiting to be indexed. Resuming from that
+    cursor and skipping indexed DOIs means no paper is lost or processed twice, however far the harvest has
+    run ahead of the upload.
+
+    Parameters
+    ----------
+    path : str
+        File the checkpoint is saved to.
+    save_interval : float
+        Minimum number of seconds between two saves made through maybe_save.
+    """
+
+    def __init__(self, path: str = "ingest_checkpoint.json", save_interval: float = 30.0):
+        self.path = path
+        self.save_interval = save_interval
+        self.indexed = set()  # DOIs in the index
+        self.done_journals = set()  # ISSNs with every accepted paper indexed
+        self._cursors = {}  # ISSN -> cursor to resume an unfinished journal from
+        self._pages = {}  # ISSN -> deque of [page cursor, next cursor, DOIs waiting to be indexed]
+        self._finished = set()  # ISSNs whose last page has been fetched
+        self.started = None  # Day the run began as YYYY-MM-DD, kept when it is resumed
+        self._last_save = 0.0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str = "ingest_checkpoint.json", save_interval: float = 30.0) -> "Checkpoint":
+        """Loads a saved checkpoint, or starts an empty one if the file does not exist.
+
+        Parameters
+        ----------
+        path : str
+            File the checkpoint is saved to.
+        save_interval : float
+            Minimum number of seconds between two saves made through maybe_save.
+
+        Returns
+        -------
+        Checkpoint
+            The loaded checkpoint.
+        """
+        checkpoint = cls(path, save_interval)
+        if os.path.exists(path):
+            with open(path, 'r', encoding='UTF-8') as file:
+                state = json.load(file)
+            checkpoint.indexed = set(state["indexed"])
+            checkpoint.done_journals = set(state["done_journals"])
+            checkpoint._cursors = state["cursors"]
+            checkpoint.started = state.get("started")
+        return checkpoint
+
+    def is_indexed(self, doi: str) -> bool:
+        return doi.lower() in self.indexed
+
+    def is_journal_done(self, issn: str) -> bool:
+        return issn in self.done_journals
+
+    def resume_cursor(self, issn: str) -> str:
+        """Gets the cursor to start paging a journal from. '*' if the journal was never started."""
+        return self._cursors.get(issn, "*")
+
+    def page_fetched(self, issn: str, cursor: str, next_cursor: str, dois: list[str]):
+        """Records a fetched page and the DOIs from it that were passed on to be indexed.
+
+        Parameters
+        ----------
+        issn : str
+            Journal the page belongs to.
+        cursor : str
+            Cursor the page was requested with.
+        next_cursor : str
+            Cursor of the following page, or an empty string if this was the last page.
+        dois : list of str
+            DOIs from the page that will be indexed.
+        """
+        with self._lock:
+            pages = self._pages.setdefault(issn, deque())
+            pages.append([cursor, next_cursor, {d.lower() for d in dois}])
+            if not next_cursor:
+                self._finished.add(issn)
+            self._trim(issn)
+
+    def mark_indexed(self, dois: list[str]):
+        """Records DOIs as successfully indexed.
+
+        Parameters
+        ----------
+        dois : list of str
+            DOIs that are now in the index.
+        """
+        with self._lock:
+            dois = {d.lower() for d in dois}
+            self.indexed.update(dois)
+            for issn, pages in self._pages.items():
+                for page in pages:
+                    page[2] -= dois
+                self._trim(issn)
+
+    def _trim(self, issn: str):
+        # Drop pages from the front once all of their papers are indexed, moving the resume cursor forward
+        pages = self._pages[issn]
+        while pages and not pages[0][2]:
+            _, next_cursor, _ = pages.popleft()
+            self._cursors[issn] = next_cursor
+        if not pages and issn in self._finished:
+            self.done_journals.add(issn)
+            self._cursors.pop(issn, None)
+
+    def has_pending(self) -> bool:
+        """Whether any paper that was passed on to be indexed has not been indexed yet."""
+        with self._lock:
+            return any(pages for pages in self._pages.values())
+
+    def save(self):
+        """Writes the checkpoint to disk. The file is replaced atomically so a crash never leaves it corrupt."""
+        with self._lock:
+            # A journal with papers still waiting resumes from the oldest page holding them
+            cursors = dict(self._cursors)
+            for issn, pages in self._pages.items():
+                if pages:
+                    cursors[issn] = pages[0][0]
+
+            state = {
+                "done_journals": sorted(self.done_journals),
+                "cursors": cursors,
+                "started": self.started,
+                "indexed": sorted(self.indexed)
+            }
+
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w', encoding='UTF-8') as file:
+            json.dump(state, file)
+        os.replace(tmp, self.path)
+        self._last_save = time.monotonic()
+
+    def maybe_save(self):
+        """Saves the checkpoint if the save interval has passed since the last save."""
+        if time.monotonic() - self._last_save >= self.save_interval:
+            self.save()
@@ -1,16 +1,204 @@
+import hashlib
+import html
 import json
-from typing import Iterator
+import os
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from email.utils import parsedate_to_datetime
+from typing import Iterable, Iterator
+from urllib.parse import quote
 
 import requests
-from bs4 import BeautifulSoup
-from sentence_transformers import SentenceTransformer
+from requests.adapters import HTTPAdapter
+from lxml import etree
 from spacy.lang.en import English
-import lxml  # needed for BeautifulSoup XML parser
 
-# Use SentenceBERT model
-model = SentenceTransformer("all-MiniLM-L6-v2")
+from checkpoint import Checkpoint
+from doi_set import DoiSet
+from embedding_pool import EmbeddingPool
+from encoders import load_encoder
+from profiler import Profiler
+from response_cache import ResponseCache
+from shards import ShardWriter
 
-def get_journals(keyword: str, min_abstracts: int, do_print: bool) -> Iterator[str]:
+# SentenceBERT model of this process, on the backend chosen by ENCODER_BACKEND (see encoders.py). Loaded on first
+# use, so that importing this module for its mappings, or running the embedding in worker processes, does not load it
+_model = None
+_model_lock = threading.Lock()
+
+
+def get_model():
+    """Gets the SentenceBERT model of this process, loading it once on the first call.
+
+    Returns
+    -------
+    SentenceTransformer
+        The model used to embed sentences in this process.
+    """
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                _model = load_encoder()
+    return _model
+
+CROSSREF_API = "https://api.crossref.org"
+# Contact address sent with every request so CrossRef routes us to its polite pool
+CROSSREF_MAILTO = os.getenv("CROSSREF_MAILTO", "")
+
+# Used when no profiler is given, records nothing
+_NO_PROFILER = Profiler(enabled=False)
+
+# spaCy pipeline that splits text into sentences, built once on first use
+_sentencizer = None
+
+# XML parser of abstracts, one per thread since lxml parsers are not meant to be shared
+_abstract_parsers = threading.local()
+# Elements whose text is not part of the abstract's prose, such as "Abstract" or "Background" headings
+_SKIPPED_TAGS = {"title", "label"}
+# Elements that start on a new line, so their text is kept apart from the text around them
+_BLOCK_TAGS = {"p", "sec", "list", "list-item", "def-list", "def-item", "disp-quote", "table-wrap", "break"}
+# Named entity references, which CrossRef abstracts sometimes take from HTML
+_ENTITY = re.compile(r"&([A-Za-z][A-Za-z0-9]*);")
+_XML_ENTITIES = {"lt", "gt", "amp", "quot", "apos"}
+_TAG = re.compile(r"<[^>]*>")
+# A < that does not start a whole tag, as in "p < 0.05", "p<0.05" or "a<b", or an & that does not start a
+# reference, as in "R & D", is text
+_BARE_LT = re.compile(r"<(?!/?[A-Za-z_][\w:.-]*(?:\s+[\w:.-]+\s*=\s*(?:\"[^\"]*\"|'[^']*'|[^\s\"'<>=`]+))*\s*/?>"
+                      r"|!--|!\[CDATA\[|\?)")
+_BARE_AMP = re.compile(r"&(?!(?:[A-Za-z][A-Za-z0-9]*|#[0-9]+|#x[0-9A-Fa-f]+);)")
+
+
+def crossref_session(pool_size: int = 8) -> requests.Session:
+    """Creates a keep-alive HTTP session for the CrossRef API.
+
+    Parameters
+    ----------
+    pool_size : int
+        Number of connections kept open for reuse. Should be at least the number of concurrent requests.
+
+    Returns
+    -------
+    requests.Session
+        Session with a sized connection pool and polite pool headers.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+
+    agent = "ResearchHelper/1.0 (https://github.com/KnowledgeSysCapstone/ResearchHelper"
+    if CROSSREF_MAILTO:
+        agent += f"; mailto:{CROSSREF_MAILTO}"
+    session.headers["User-Agent"] = agent + ")"
+    return session
+
+
+def _retry_delay(resp: requests.Response, attempt: int, backoff: float) -> float:
+    # Prefer the server's Retry-After (seconds or HTTP date) over our own exponential backoff
+    retry_after = resp.headers.get("Retry-After") if resp is not None else None
+    if retry_after:
+        try:
+            return max(float(retry_after), 0.0)
+        except ValueError:
+            try:
+                return max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0.0)
+            except (TypeError, ValueError):
+                pass
+    return backoff * 2 ** attempt
+
+
+def fetch_page(session: requests.Session, url: str, max_retries: int = 5, backoff: float = 1.0,
+               cache: ResponseCache = None, profiler: Profiler = None) -> dict[str]:
+    """Fetches one page of results from the CrossRef API, retrying when rate limited.
+
+    Parameters
+    ----------
+    session : requests.Session
+        Session used to make the request.
+    url : str
+        Full URL of the page, including its cursor.
+    max_retries : int
+        Number of times to retry after a 429, a server error or a dropped connection.
+    backoff : float
+        Seconds to wait before the first retry when the server gives no Retry-After. Doubles on every retry.
+    cache : ResponseCache, optional
+        Cache to serve the page from and store it in. In replay mode the network is never used.
+    profiler : Profiler, optional
+        Profiler to record cache lookups in as the "cache" stage, and requests, retries included, as "fetch".
+
+    Returns
+    -------
+    dict of str
+        The "message" object of the CrossRef response.
+    """
+    return _fetch_page(session, url, max_retries, backoff, cache, profiler)[0]
+
+
+def _fetch_page(session: requests.Session, url: str, max_retries: int = 5, backoff: float = 1.0,
+                cache: ResponseCache = None, profiler: Profiler = None, read_cache: bool = True,
+                network: bool = True) -> tuple[dict[str] | None, bool]:
+    # Fetches a page as fetch_page does and tells whether it came from the cache. Without read_cache the cache is
+    # only written to. Without network a page missing from the cache gives None instead of being requested
+    profiler = profiler or _NO_PROFILER
+    if cache is not None and read_cache:
+        with profiler.stage("cache"):
+            message = cache.get(url)
+        if message is not None:
+            return message, True
+    if not network:
+        return None, False
+
+    with profiler.stage("fetch") as counts:
+        message = _request_page(session, url, max_retries, backoff, counts)
+    if cache is not None:
+        cache.put(url, message)
+    return message, False
+
+
+def _request_page(session: requests.Session, url: str, max_retries: int, backoff: float,
+                  counts: dict[str, int]) -> dict[str]:
+    # Request a page from CrossRef, retrying when rate limited, and count the bytes received
+    for attempt in range(max_retries + 1):
+        try:
+            resp = session.get(url, timeout=60)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == max_retries:
+                raise
+            time.sleep(_retry_delay(None, attempt, backoff))
+            continue
+
+        if resp.status_code == 429 or resp.status_code >= 500:
+            if attempt == max_retries:
+                resp.raise_for_status()
+            time.sleep(_retry_delay(resp, attempt, backoff))
+            continue
+
+        resp.raise_for_status()
+        counts["bytes"] = len(resp.content)
+        return json.loads(resp.text)["message"]
+
+
+def _journals_url(keyword: str, cursor: str) -> str:
+    return "{}/journals?query={}&cursor={}".format(CROSSREF_API, quote(keyword), quote(cursor))
+
+
+def _works_url(issn: str, cursor: str, from_index_date: str = None) -> str:
+    # Filters for journal articles with abstracts and sorts by number of times cited
+    # With from_index_date, only works CrossRef has added or updated since that day are listed
+    filters = "issn:{},type:journal-article,has-abstract:true".format(issn)
+    if from_index_date:
+        filters += ",from-index-date:{}".format(from_index_date)
+    return ("{}/works/?filter={}&sort=is-referenced-by-count"
+            "&select=DOI,author,published,title,container-title,volume,issue,page,indexed,abstract,"
+            "is-referenced-by-count,type,ISSN&cursor={}".format(CROSSREF_API, filters, quote(cursor)))
+
+
+def get_journals(keyword: str, min_abstracts: int, do_print: bool,
+                 session: requests.Session = None, cache: ResponseCache = None,
+                 profiler: Profiler = None) -> Iterator[str]:
     """Collects journals from CrossRef that match a query
 
     Parameters
@@ -21,23 +209,38 @@ def get_journals(keyword: str, min_abstracts: int, do_print: bool) -> Iterator[s
         Minimum number of abstracts in journal. Journals with less are not returned.
     do_print : bool
         Whether to print progress through API calls.
+    session : requests.Session, optional
+        Session to reuse connections from. A new one is created if not given.
+    cache : ResponseCache, optional
+        Cache of CrossRef responses to read from and add to.
+    profiler : Profiler, optional
+        Profiler to record requests in.
 
     Yields
     ------
     str
         Next ISSN for electronic edition of journal matching query.
     """
+    session = session or crossref_session(1)
     cursor = '*'  # Cursor for iterating pages
     # issns = []
     count = 0
     total_journals = -1
     i = 0
+    # Cursors of cached pages are from an earlier harvest and have most likely expired, see get_papers
+    cached = False  # Whether the last page came from the cache
+    fresh = False  # Whether the listing is being paged again without reading the cache
+    yielded = set()
 
     # Iterate over pages
     while cursor:
         # Query metadata for next page
-        resp = requests.get("https://api.crossref.org/journals?query={}&cursor={}".format(keyword, cursor))
-        metadata = json.loads(resp.text)["message"]
+        metadata, cached = _fetch_page(session, _journals_url(keyword, cursor), cache=cache, profiler=profiler,
+                                       read_cache=not fresh, network=not cached)
+        if metadata is None:
+            # The cached listing ends before this page. Page it again from the start with fresh cursors
+            cursor, fresh, i = '*', True, 0
+            continue
         cursor = metadata["next-cursor"] if len(metadata["items"]) == metadata["items-per-page"] else ""
 
         if total_journals < 0:
@@ -52,6 +255,9 @@ def get_journals(keyword: str, min_abstracts: int, do_print: bool) -> Iterator[s
                 # Add electronic ISSN for journal if it has enough abstracts
                 for x in journal["issn-type"]:
                     if x["type"] == 'electronic':
+                        if x["value"] in yielded:
+                            break  # Already passed on before the listing was paged again
+                        yielded.add(x["value"])
 
                         if do_print:
                             print(f"Journal {i} out of {total_journals}")
@@ -69,8 +275,53 @@ def get_journals(keyword: str, min_abstracts: int, do_print: bool) -> Iterator[s
     # return issns
 
 
-def get_papers(issns: Iterator[str], min_cited: int, do_print: bool) -> Iterator[dict[str]]:
-    """Collects the most highly cited papers from the given journal.
+def get_topic_journals(keywords: Iterable[str], min_abstracts: int, do_print: bool,
+                       session: requests.Session = None, cache: ResponseCache = None,
+                       profiler: Profiler = None) -> dict[str, list[str]]:
+    """Collects the journals of several topics, each journal once.
+
+    Parameters
+    ----------
+    keywords : iterable of str
+        Words or phrases used to query CrossRef for journals, one per topic.
+    min_abstracts : int
+        Minimum number of abstracts in journal. Journals with less are not returned.
+    do_print : bool
+        Whether to print progress through API calls.
+    session : requests.Session, optional
+        Session to reuse connections from. A new one is created if not given.
+    cache : ResponseCache, optional
+        Cache of CrossRef responses to read from and add to.
+    profiler : Profiler, optional
+        Profiler to record requests in.
+
+    Returns
+    -------
+    dict of str to list of str
+        Electronic ISSN of every journal matching any of the topics, in the order found, to the topics it matched.
+    """
+    journals = {}
+    for keyword in keywords:
+        for issn in get_journals(keyword, min_abstracts, do_print, session, cache, profiler):
+            topics = journals.setdefault(issn, [])
+            if keyword not in topics:
+                topics.append(keyword)
+    return journals
+
+
+def get_papers(issns: Iterator[str], min_cited: int, do_print: bool, session: requests.Session = None,
+               fetch_workers: int = 4, cache: ResponseCache = None,
+               checkpoint: Checkpoint = None, seen: DoiSet = None,
+               from_index_date: str = None, profiler: Profiler = None) -> Iterator[dict[str]]:
+    """Collects the most highly cited papers from the given journals.
+
+    Several journals are paged through at once. Each journal's pages are still requested in order since every
+    page holds the cursor for the next one, but pages of different journals are fetched in parallel. A paper
+    listed under several of the journals is only yielded the first time it is found.
+
+    Cached pages hold the cursors of an earlier harvest, which CrossRef expires after a few minutes. So once a
+    journal's page comes from the cache, its following pages are only read from the cache, and if one is missing,
+    for example after lowering min_cited, the journal is paged again from the start without reading the cache.
 
     Parameters
     ----------
@@ -80,60 +331,123 @@ def get_papers(issns: Iterator[str], min_cited: int, do_print: bool) -> Iterator
         Minimum number of times a paper must be cited by other papers in CrossRef in order to be included.
     do_print : bool
         Whether to print progress through API calls.
+    session : requests.Session, optional
+        Session to reuse connections from. A new one is created if not given.
+    fetch_workers : int
+        Maximum number of journals, and so requests, in flight at once.
+    cache : ResponseCache, optional
+        Cache of CrossRef responses to read from and add to.
+    checkpoint : Checkpoint, optional
+        Progress of an earlier run. Finished journals are skipped and papers that are already indexed are not
+        yielded. Unfinished ones resume from their saved cursor if its pages are cached, and are otherwise paged
+        from the start, since the cursor has most likely expired. Every page fetched is recorded in it.
+    seen : DoiSet, optional
+        DOIs already seen, shared across calls. Papers in it are not yielded and yielded papers are added to it.
+        A new set is used if not given.
+    from_index_date : str, optional
+        Date as YYYY-MM-DD. Only papers CrossRef has added or updated on or after it are collected.
+    profiler : Profiler, optional
+        Profiler to record requests in.
 
     Yields
     ------
     dict of str
-        Metadata for next DOI.
+        Metadata for next DOI. Papers of different journals are interleaved.
     """
-    for issn in issns:
-        cursor = "*"  # Cursor for iterating pages
-        total_papers = -1
-        count_accept = 0
-        # ret_obj = {}
-
-        # Iterate over pages
-        while cursor:
-
-            # Query next page. Filters for journal articles with abstracts and sorts by number of times cited
-            resp = requests.get("https://api.crossref.org/works/?filter=issn:{},type:journal-article,"
-                                "has-abstract:true&sort=is-referenced-by-count&select=DOI,author,published,title,"
-                                "container-title,volume,issue,page,indexed,abstract,is-referenced-by-count,type,"
-                                "ISSN&cursor={}".format(issn, cursor))
-            metadata = json.loads(resp.text)["message"]
-            cursor = metadata["next-cursor"] if len(metadata["items"]) == metadata["items-per-page"] else ""
-
-            if total_papers < 0:
-                total_papers = metadata["total-results"]
-
-            # Iterate over papers on page
-            for paper in metadata["items"]:
-                count_accept += 1
-                if do_print:
-                    print("\r", "                                                                         ", end='')
-                    print("\r",
-                          f"acc:{count_accept - 1} total:{total_papers} refs:{paper['is-referenced-by-count']}",
-                          end='')
-                if paper["is-referenced-by-count"] >= min_cited:
-                    # Accept paper and add metadata paper to return object
-                    yield paper
-
-                    # ret_obj[paper["DOI"]] = paper
+    session = session or crossref_session(fetch_workers)
+    seen = seen if seen is not None else DoiSet()
+    issns = iter(issns)
+
+    with ThreadPoolExecutor(fetch_workers) as executor:
+        in_flight = {}  # Future of the next page -> state of the journal it belongs to
+
+        def submit(journal):
+            url = _works_url(journal["issn"], journal["cursor"], from_index_date)
+            # A cursor from a cached page or a checkpoint may have expired, so it is never sent to CrossRef
+            network = not journal["cached"]
+            in_flight[executor.submit(_fetch_page, session, url, cache=cache, profiler=profiler,
+                                      read_cache=not journal["fresh"], network=network)] = journal
+
+        def restart(journal):
+            # Page the journal from the start with fresh cursors. Papers already passed on are skipped
+            journal.update(cursor="*", cached=False, fresh=True, total=-1, accepted=0)
+            submit(journal)
+
+        def start_next() -> bool:
+            issn = next(issns, None)
+            while checkpoint is not None and issn is not None and checkpoint.is_journal_done(issn):
+                issn = next(issns, None)
+            if issn is None:
+                return False
+
+            # A saved cursor can only be followed through cached pages. Without a cache the journal is paged from
+            # the start, and papers already indexed are skipped
+            cursor = checkpoint.resume_cursor(issn) if checkpoint is not None and cache is not None else "*"
+            submit({"issn": issn, "cursor": cursor, "cached": cursor != "*", "fresh": False, "total": -1,
+                    "accepted": 0})
+            return True
+
+        while len(in_flight) < fetch_workers and start_next():
+            pass
+
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                journal = in_flight.pop(future)
+                metadata, journal["cached"] = future.result()
+                if metadata is None:
+                    # The cached pages of the journal, or of a resumed cursor, end before this one
+                    restart(journal)
+                    continue
+
+                cursor = metadata["next-cursor"] if len(metadata["items"]) == metadata["items-per-page"] else ""
+
+                if journal["total"] < 0:
+                    journal["total"] = metadata["total-results"]
+
+                # Iterate over papers on page
+                accepted = []
+                for paper in metadata["items"]:
+                    if paper["is-referenced-by-count"] < min_cited:
+                        # Once citations drop below minimum, stop iterating this journal
+                        cursor = ""
+                        break
 
+                    # Accept paper
+                    journal["accepted"] += 1
+                    if do_print:
+                        print("\r", "                                                                         ", end='')
+                        print("\r",
+                              f"acc:{journal['accepted'] - 1} total:{journal['total']} "
+                              f"refs:{paper['is-referenced-by-count']}",
+                              end='')
+                    # Skip papers already indexed or already passed on from another journal
+                    if (checkpoint is None or not checkpoint.is_indexed(paper["DOI"])) and seen.add(paper["DOI"]):
+                        accepted.append(paper)
+
+                # Record the page before any of its papers are passed on
+                if checkpoint is not None:
+                    checkpoint.page_fetched(journal["issn"], journal["cursor"], cursor, [p["DOI"] for p in accepted])
+
+                yield from accepted
+
+                if cursor:
+                    # Request the journal's next page
+                    journal["cursor"] = cursor
+                    submit(journal)
                 else:
-                    # Once citations drop below minimum, stop iterating this journal
-                    cursor = ""
-                    count_accept -= 1
-                    break
-
-        if do_print:
-            print("\r", f"Journal {issn}. accept {count_accept} / {total_papers}")
-        # return ret_obj
+                    if do_print:
+                        print("\r", f"Journal {journal['issn']}. accept {journal['accepted']} / {journal['total']}")
+                    start_next()
 
 
 def parse_abstract(raw: str) -> str:
     """Converts XML string abstract as given by CrossRef into plaintext.
 
+    The text of every paragraph (p or jats:p) is joined in order, leaving out section titles. Abstracts without
+    paragraphs give all of their text, and abstracts with no tags at all are returned as they are. Malformed
+    markup is parsed as far as possible, and if that fails the tags are stripped. Whitespace is collapsed.
+
     Parameters
     ----------
     raw : str
@@ -142,16 +456,65 @@ def parse_abstract(raw: str) -> str:
     Returns
     -------
     str
-        Plaintext extracted from abstract.
+        Plaintext extracted from abstract. Empty if there is none.
     """
-    # Parse using BeautifulSoup and lxml's XML parser
-    soup = BeautifulSoup("<root>"+raw+"</root>", features="xml")
-    # Find text with label 'p' or 'jats:p' and convert rest of tree to plaintext by removing all tags
-    findp = soup.find('p')
-    if findp:
-        return findp.get_text()
-
-    return soup.find('jats:p').get_text()
+    # HTML entities are not defined in XML, so turn them into the characters they stand for first
+    raw = _ENTITY.sub(_replace_entity, _BARE_LT.sub("&lt;", _BARE_AMP.sub("&amp;", raw)))
+
+    parser = getattr(_abstract_parsers, "parser", None)
+    if parser is None:
+        # recover keeps going past undeclared namespace prefixes and broken markup
+        parser = etree.XMLParser(recover=True, resolve_entities=False, no_network=True, remove_comments=True,
+                                 remove_pis=True)
+        _abstract_parsers.parser = parser
+
+    try:
+        root = etree.fromstring(("<root>" + raw + "</root>").encode("utf-8"), parser)
+    except etree.XMLSyntaxError:
+        root = None
+    if root is None:
+        return " ".join(html.unescape(_TAG.sub(" ", raw)).split())
+
+    # Outermost paragraphs only, since a paragraph's text already includes any paragraph nested in it
+    paragraphs = [e for e in root.iter() if _local_name(e) == "p"
+                  and not any(_local_name(a) == "p" for a in e.iterancestors())]
+    parts = []
+    for element in paragraphs or [root]:
+        _collect_text(element, parts)
+        parts.append(" ")
+    return " ".join("".join(parts).split())
+
+
+def _replace_entity(match: re.Match) -> str:
+    # Keep XML's own entities for the parser, replace HTML ones and keep unknown ones as literal text
+    name = match.group(1)
+    if name in _XML_ENTITIES:
+        return match.group(0)
+    char = html.unescape(match.group(0))
+    return html.escape(char) if char != match.group(0) else "&amp;" + name + ";"
+
+
+def _local_name(element) -> str:
+    # Tag without namespace or prefix. Comments and other nodes have none
+    if not isinstance(element.tag, str):
+        return ""
+    return element.tag.rpartition("}")[2].rpartition(":")[2]
+
+
+def _collect_text(element, parts: list[str]):
+    # Text of an element and its children in document order, skipping headings but not the text after them
+    if element.text:
+        parts.append(element.text)
+    for child in element:
+        name = _local_name(child)
+        if name in _BLOCK_TAGS:
+            parts.append(" ")
+        if name not in _SKIPPED_TAGS:
+            _collect_text(child, parts)
+        if name in _BLOCK_TAGS:
+            parts.append(" ")
+        if child.tail:
+            parts.append(child.tail)
 
 
 def separate_sentences(abstract: str) -> list[str]:
@@ -167,14 +530,51 @@ def separate_sentences(abstract: str) -> list[str]:
     list of str
         List of individual sentences.
     """
-    # Use the sentencizer from spaCy to maximize speed
-    nlp = English()
-    nlp.add_pipe("sentencizer")
-
-    doc = nlp(abstract)
+    doc = get_sentencizer()(abstract)
     return [sent.text.strip() for sent in doc.sents]
 
 
+def get_sentencizer() -> English:
+    """Gets the spaCy pipeline used to split text into sentences, building it once on the first call.
+
+    Returns
+    -------
+    English
+        Blank English pipeline with only the rule-based sentencizer, the fastest way spaCy splits sentences.
+    """
+    global _sentencizer
+    if _sentencizer is None:
+        nlp = English()
+        nlp.add_pipe("sentencizer")
+        _sentencizer = nlp
+    return _sentencizer
+
+
+def split_sentences(texts: Iterable[tuple[str, object]], batch_size: int = 64,
+                    n_process: int = 1) -> Iterator[tuple[list[str], object]]:
+    """Splits a stream of texts into sentences, passing them through the spaCy pipeline in batches.
+
+    Texts are read lazily, a batch at a time, so the stream can be as long as a whole harvest.
+
+    Parameters
+    ----------
+    texts : Iterable of tuple
+        Pairs of a text and any context to carry along with it, such as the paper it came from.
+    batch_size : int
+        Number of texts handed to spaCy at once.
+    n_process : int
+        Number of processes splitting batches. More than one forks the current process, so it is best used
+        when the model is not loaded in this process, as with an EmbeddingPool.
+
+    Yields
+    ------
+    tuple of list of str and object
+        Sentences of the next text, in input order, and its context.
+    """
+    for doc, context in get_sentencizer().pipe(texts, as_tuples=True, batch_size=batch_size, n_process=n_process):
+        yield [sent.text.strip() for sent in doc.sents], context
+
+
 def embed_vectors(title: str, sentences: list[str]) -> dict[str, list[int]]:
     """Add titles to sentences for context and embed as vectors.
 
@@ -194,33 +594,199 @@ def embed_vectors(title: str, sentences: list[str]) -> dict[str, list[int]]:
     input_text = [title + ": " + s for s in sentences]
 
     # Embed text into vectors
-    embeddings = model.encode(input_text)
+    embeddings = get_model().encode(input_text)
     return {inp: embed for inp, embed in zip(input_text, embeddings.tolist())}
 
 
-def get_documents(keyword: str, min_abstracts: int = 5000, min_cited: int = 100,
-                  do_print: bool = False) -> Iterator[dict[str]]:
+def text_fingerprint(metadata: dict[str]) -> str:
+    """Gets a fingerprint of the text a paper's vectors are embedded from.
+
+    Parameters
+    ----------
+    metadata : dict of str
+        Metadata of the paper, either as listed by CrossRef or as stored in the index. Its title and abstract are
+        kept as CrossRef gives them, so both give the same fingerprint.
+
+    Returns
+    -------
+    str
+        Hash of the DOI, title and raw abstract. It only changes when the embedded text can have changed.
+    """
+    title = metadata.get("title") or []
+    title = [title] if isinstance(title, str) else title
+    text = "\0".join([metadata["DOI"].lower(), "\n".join(title), metadata.get("abstract") or ""])
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def embed_documents(papers: Iterable[tuple[dict[str], list[str] | None]], batch_size: int = 256,
+                    max_batch_bytes: int = 128 * 1024, do_print: bool = False,
+                    profiler: Profiler = None, pool: EmbeddingPool = None) -> Iterator[dict[str]]:
+    """Embeds the sentences of many papers together in large batches.
+
+    Sentences from consecutive papers are pooled until either limit is reached, encoded with a single call to
+    the model, and the vectors are put back on the paper they came from. Papers are yielded in the order they
+    were received as soon as all of their sentences have been embedded. With a pool, several batches are encoded
+    at once in worker processes while the next ones are gathered.
+
+    Parameters
+    ----------
+    papers : Iterable of tuple
+        Pairs of paper metadata and the title-prefixed sentences of that paper to embed. Papers with None instead
+        of sentences are passed on in order as documents of only their metadata, without "embedded_paper".
+    batch_size : int
+        Maximum number of sentences encoded per call to the model.
+    max_batch_bytes : int
+        Maximum total size in bytes of the UTF-8 sentences encoded per call to the model.
+    do_print : bool
+        Whether to print progress through batches.
+    profiler : Profiler, optional
+        Profiler to record calls to the model in as the "embed" stage.
+    pool : EmbeddingPool, optional
+        Worker processes to encode batches in. Batches are encoded in this process if not given.
+
+    Yields
+    ------
+    dict of str
+        Document of metadata and vectors for next paper.
+    """
+    profiler = profiler or _NO_PROFILER
+    pending = deque()  # Papers waiting on their vectors, in input order
+    batch = []  # (paper entry, sentence position, text) for every sentence in the current batch
+    batch_bytes = 0
+    in_flight = deque()  # (batch, its size in bytes, future of its vectors) sent to the pool, in order
+
+    def store(done_batch, done_bytes, embeddings, start, seconds):
+        # Put a batch's vectors back on their papers
+        papers = 0
+        for (entry, pos, _), embed in zip(done_batch, embeddings.tolist()):
+            entry["vectors"][pos] = embed
+            entry["missing"] -= 1
+            # Papers count as embedded with the batch holding their last sentence
+            if entry["missing"] == 0:
+                papers += 1
+        profiler.add("embed", start, seconds, papers=papers, sentences=len(done_batch), bytes=done_bytes)
+        if do_print:
+            print(f" - embedded {len(done_batch)}", end='')
+
+    def collect():
+        # Wait for the oldest batch sent to the pool
+        done_batch, done_bytes, future = in_flight.popleft()
+        embeddings, seconds = future.result()
+        store(done_batch, done_bytes, embeddings, time.perf_counter() - seconds, seconds)
+
+    def flush():
+        nonlocal batch, batch_bytes
+        texts = [text for _, _, text in batch]
+        if pool is None:
+            start = time.perf_counter()
+            embeddings = get_model().encode(texts, batch_size=len(batch))
+            store(batch, batch_bytes, embeddings, start, time.perf_counter() - start)
+        else:
+            in_flight.append((batch, batch_bytes, pool.submit(texts)))
+            # Block only once the pool is full, but take any finished batch so its papers are released early
+            while in_flight and (len(in_flight) >= pool.max_in_flight or in_flight[0][2].done()):
+                collect()
+        batch = []
+        batch_bytes = 0
+
+    def ready() -> Iterator[dict[str]]:
+        # Only release papers from the front so that output order matches input order
+        while pending and pending[0]["missing"] == 0:
+            entry = pending.popleft()
+            if entry["inputs"] is None:
+                yield {"metadata": entry["metadata"]}
+                continue
+            yield {
+                "metadata": entry["metadata"],
+                "embedded_paper": [{"vector": v, "title-and-sentence": t}
+                                   for t, v in zip(entry["inputs"], entry["vectors"])]
+            }
+
+    for metadata, inputs in papers:
+        entry = {"metadata": metadata, "inputs": inputs, "vectors": [None] * len(inputs or ()),
+                 "missing": len(inputs or ())}
+        pending.append(entry)
+
+        for pos, text in enumerate(inputs or ()):
+            batch.append((entry, pos, text))
+            batch_bytes += len(text.encode("utf-8"))
+            if len(batch) >= batch_size or batch_bytes >= max_batch_bytes:
+                flush()
+
+        yield from ready()
+
+    if batch:
+        flush()
+    while in_flight:
+        collect()
+        yield from ready()
+    yield from ready()
+
+
+def get_documents(keyword: str | Iterable[str], min_abstracts: int = 5000, min_cited: int = 100,
+                  do_print: bool = False, batch_size: int = 256,
+                  max_batch_bytes: int = 128 * 1024, fetch_workers: int = 4,
+                  cache: ResponseCache = None, checkpoint: Checkpoint = None,
+                  seen: DoiSet = None, from_index_date: str = None,
+                  profiler: Profiler = None, pool: EmbeddingPool = None, sentence_batch_size: int = 64,
+                  sentence_processes: int = 1, known_texts: DoiSet = None) -> Iterator[dict[str]]:
     """Gets documents containing paper metadata and vectors from journals matching query.
 
     Parameters
     ----------
-    keyword : str
-        Word or phrase used to query CrossRef for journals.
+    keyword : str or iterable of str
+        Word or phrase used to query CrossRef for journals, or several of them, one per topic. Journals matching
+        more than one topic are collected once, and every paper is tagged with the topics of its journal.
     min_abstracts : int
         Minimum number of abstracts in journal. Journals with less are not returned.
     min_cited : int
         Minimum number of times a paper must be cited by other papers in CrossRef in order to be included.
     do_print : bool
         Whether to print progress through API calls.
+    batch_size : int
+        Maximum number of sentences, pooled across papers, encoded per call to the model.
+    max_batch_bytes : int
+        Maximum total size in bytes of the sentences encoded per call to the model.
+    fetch_workers : int
+        Maximum number of journals paged through concurrently.
+    cache : ResponseCache, optional
+        Cache of CrossRef responses. With a replay-only cache the whole run is served from disk.
+    checkpoint : Checkpoint, optional
+        Progress to resume from and record into. Papers already indexed are skipped before being parsed.
+    seen : DoiSet, optional
+        DOIs to skip, such as those already in the index. Every paper found is added to it, so a paper listed
+        under several journals is parsed and embedded once.
+    from_index_date : str, optional
+        Date as YYYY-MM-DD. Only papers CrossRef has added or updated on or after it are collected, which turns a
+        full harvest into an incremental refresh.
+    profiler : Profiler, optional
+        Profiler to record the time spent fetching, parsing, splitting into sentences and embedding in.
+    pool : EmbeddingPool, optional
+        Worker processes to embed sentences in. Sentences are embedded in this process if not given.
+    sentence_batch_size : int
+        Number of abstracts split into sentences at once.
+    sentence_processes : int
+        Number of processes splitting abstracts into sentences, see split_sentences.
+    known_texts : DoiSet, optional
+        Fingerprints, see text_fingerprint, of the papers already in the index. A paper whose title and abstract
+        are unchanged is not parsed or embedded again, and is yielded without "embedded_paper" so that only its
+        metadata, such as its citation count, is updated.
 
     Yields
     ------
     dict of str
-        Document of metadata and vectors for next paper.
+        Document of metadata and vectors for next paper, or of only metadata for an unchanged paper.
     """
 
-    journals_it = get_journals(keyword, min_abstracts, do_print)
-    papers_it = get_papers(journals_it, min_cited, do_print)
+    # One pooled session is shared by the journal listing and every paper fetch
+    session = crossref_session(fetch_workers + 1)
+    profiler = profiler or _NO_PROFILER
+    # Journals of every topic are listed up front, so that each paper can be tagged with all the topics of its
+    # journal before it is indexed
+    keywords = [keyword] if isinstance(keyword, str) else list(keyword)
+    journals = get_topic_journals(keywords, min_abstracts, do_print, session, cache, profiler)
+    papers_it = get_papers(iter(journals), min_cited, do_print, session, fetch_workers, cache, checkpoint, seen,
+                           from_index_date, profiler)
 
     def reformat_date(og_dict, label):
         date_parts = ["year", "month", "day"]
@@ -230,23 +796,62 @@ def get_documents(keyword: str, min_abstracts: int = 5000, min_cited: int = 100,
             new_format[date_parts[i]] = p
         og_dict[label] = new_format
 
-    for paper in papers_it:
-        abstract = paper["abstract"]
-        parsed = parse_abstract(abstract)  # Convert abstract to plaintext
-        if do_print:
-            print(" - parsed", end='')
-        sentenced = separate_sentences(parsed)  # Separate abstract into sentences
-        if do_print:
-            print(" - sentenced", end='')
-        vectors = embed_vectors(paper["title"][0], sentenced)  # Embed sentences with title into vectors
-        if do_print:
-            print(" - embedded", end='')
-
-
-
+    def parse(papers):
+        # Each paper is carried through the sentence splitter with whether its text is already embedded in the
+        # index. The flag travels with it, since splitting in several processes hands back copies of the papers
+        for paper in papers:
+            if known_texts is not None and text_fingerprint(paper) in known_texts:
+                yield "", (paper, True)
+                continue
+            abstract = paper["abstract"]
+            with profiler.stage("parse", papers=1, bytes=len(abstract.encode("utf-8"))):
+                parsed = parse_abstract(abstract)  # Convert abstract to plaintext
+            if do_print:
+                print(" - parsed", end='')
+            yield parsed, (paper, False)
+
+    def prepare(papers):
+        # Time spent pulling parsed abstracts out of parse, so that it can be left out of the sentences stage
+        upstream = 0.0
+
+        def timed(items):
+            nonlocal upstream
+            items = iter(items)
+            while True:
+                start = time.perf_counter()
+                item = next(items, None)
+                upstream += time.perf_counter() - start
+                if item is None:
+                    return
+                yield item
+
+        # Separate abstracts into sentences, streamed through one spaCy pipeline in batches
+        split = split_sentences(timed(parse(papers)), sentence_batch_size, sentence_processes)
+        while True:
+            start, before = time.perf_counter(), upstream
+            item = next(split, None)
+            if item is None:
+                return
+            sentenced, (paper, unchanged) = item
+            if unchanged:
+                yield clean(paper), None
+                continue
+            profiler.add("sentences", start, time.perf_counter() - start - (upstream - before), papers=1,
+                         sentences=len(sentenced), bytes=sum(len(s.encode("utf-8")) for s in sentenced))
+            if do_print:
+                print(" - sentenced", end='')
+
+            # Title is prepended to sentences for context. Duplicates are dropped as in embed_vectors
+            title = paper["title"][0]
+            inputs = list(dict.fromkeys(title + ": " + s for s in sentenced))
+
+            yield clean(paper), inputs
+
+    def clean(paper):
         # Remove unnecessary info from certain fields
         if paper.get("author"):
-            paper["author"] = [{"given": x.get("given", ""), "family": x.get("family", "")} for x in paper["author"]]
+            paper["author"] = [{"given": x.get("given", ""), "family": x.get("family", "")}
+                               for x in paper["author"]]
         else:
             paper["author"] = []
 
@@ -257,17 +862,111 @@ def get_documents(keyword: str, min_abstracts: int = 5000, min_cited: int = 100,
 
         paper["text-type"] = paper["type"]
         del paper["type"]
-        vectors_dicts = [{"vector": vectors[x], "title-and-sentence": x} for x in vectors]
 
-        yield {
-            "metadata": paper,
-            "embedded_paper": vectors_dicts
+        paper["topics"] = sorted({topic for issn in paper.get("ISSN", []) for topic in journals.get(issn, [])})
+        return paper
+
+    # Sentences are embedded in batches that span many papers
+    yield from embed_documents(prepare(papers_it), batch_size, max_batch_bytes, do_print, profiler, pool)
+
+
+# Vector index types accepted by Elasticsearch. The quantized ones keep the float vectors on disk but search
+# over int8, int4 or single bit (bbq) copies, cutting off-heap memory by roughly 4x, 8x and 32x
+VECTOR_INDEX_TYPES = ("hnsw", "int8_hnsw", "int4_hnsw", "bbq_hnsw", "flat", "int8_flat", "int4_flat", "bbq_flat")
+
+
+def vector_index_options(index_type: str = "int8_hnsw", m: int = 16, ef_construction: int = 100) -> dict[str]:
+    """Get the index_options of the dense_vector field.
+
+    Parameters
+    ----------
+    index_type : str
+        One of VECTOR_INDEX_TYPES. The flat types search exhaustively and build no graph.
+    m : int
+        Number of neighbors each vector is linked to in the HNSW graph. Ignored by flat types.
+    ef_construction : int
+        Number of candidates considered when linking a vector into the HNSW graph. Ignored by flat types.
+
+    Returns
+    -------
+    dict of str
+        The index_options object for the mapping.
+    """
+    if index_type not in VECTOR_INDEX_TYPES:
+        raise ValueError(f"Unknown vector index type {index_type!r}, expected one of {VECTOR_INDEX_TYPES}")
+
+    options = {"type": index_type}
+    if index_type.endswith("hnsw"):
+        options["m"] = m
+        options["ef_construction"] = ef_construction
+    return options
+
+
+def _metadata_mapping() -> dict[str]:
+    # Mapping of the paper metadata, shared by the nested layout and the metadata index of the flat layout
+    return {
+        "type": "object",
+        "properties": {
+        "DOI": {"type": "keyword"},
+        "author": {
+            "type": "object",
+            "properties": {
+            "given": {"type": "text"},
+            "family": {"type": "text"}
+            }
+        },
+        "published": {
+            "type": "object",
+            "properties": {
+            "year": {"type": "integer"},
+            "month": {"type": "integer"},
+            "day": {"type": "integer"}
+            }
+        },
+        "title": {"type": "text"},
+        "container-title": {"type": "text"},
+        "volume": {"type": "integer"},
+        "issue": {"type": "integer"},
+        "page": {"type": "text"},
+        "indexed": {
+            "type": "object",
+            "properties": {
+            "year": {"type": "integer"},
+            "month": {"type": "integer"},
+            "day": {"type": "integer"}
+            }
+        },
+        "abstract": {"type": "text"},
+        "is-referenced-by-count": {"type": "integer"},
+        "text-type": {"type": "keyword"},
+        "ISSN": {"type": "keyword"},
+        "topics": {"type": "keyword"}
         }
+    }
+
+
+def _vector_mapping(index_type: str, m: int, ef_construction: int) -> dict[str]:
+    return {
+        "type": "dense_vector",
+        "dims": 384,
+        "index": True,
+        "similarity": "cosine",
+        "index_options": vector_index_options(index_type, m, ef_construction)
+    }
 
 
-def elasticsearch_mappings() -> dict[str]:
+def elasticsearch_mappings(index_type: str = "int8_hnsw", m: int = 16, ef_construction: int = 100) -> dict[str]:
     """Get mappings schema for Elasticsearch
 
+    Parameters
+    ----------
+    index_type : str
+        How sentence vectors are indexed, one of VECTOR_INDEX_TYPES.
+    m : int
+        Number of neighbors each vector is linked to in the HNSW graph.
+    ef_construction : int
+        Number of candidates considered when linking a vector into the HNSW graph.
+
     Returns
     -------
     dict of str
@@ -280,53 +979,56 @@ def elasticsearch_mappings() -> dict[str]:
                 "embedded_paper": {
                     "type": "nested",
                     "properties": {
-                        "vector": {
-                            "type": "dense_vector",
-                            "dims": 384,
-                            "index": True,
-                            "similarity": "cosine"
-                        },
+                        "vector": _vector_mapping(index_type, m, ef_construction),
                         "title-and-sentence": {
                             "type": "text"
                         }
                     }
                 },
+                "metadata": _metadata_mapping()
+            }
+        }
+    }
+
+
+def sentence_mappings(index_type: str = "int8_hnsw", m: int = 16, ef_construction: int = 100) -> dict[str]:
+    """Get mappings schema of the sentence index in the flat layout
+
+    In the flat layout every sentence is its own document holding the DOI of its paper, so a search can return
+    several sentences of the same paper and needs no nested join. Paper metadata lives in a separate index with
+    the DOI as document ID, see paper_mappings. Only the metadata fields searches filter on are copied into each
+    sentence, under the same paths as in the nested layout.
+
+    Parameters
+    ----------
+    index_type : str
+        How sentence vectors are indexed, one of VECTOR_INDEX_TYPES.
+    m : int
+        Number of neighbors each vector is linked to in the HNSW graph.
+    ef_construction : int
+        Number of candidates considered when linking a vector into the HNSW graph.
+
+    Returns
+    -------
+    dict of str
+        Mappings dictionary describing the Elasticsearch schema that accepts the documents of flatten_document.
+
+    """
+    return {
+        "mappings": {
+            "properties": {
+                "doi": {"type": "keyword"},
+                "position": {"type": "integer"},
+                "title-and-sentence": {"type": "text"},
+                "vector": _vector_mapping(index_type, m, ef_construction),
                 "metadata": {
                     "type": "object",
                     "properties": {
-                    "DOI": {"type": "keyword"},
-                    "author": {
-                        "type": "object",
-                        "properties": {
-                        "given": {"type": "text"},
-                        "family": {"type": "text"}
-                        }
-                    },
-                    "published": {
-                        "type": "object",
-                        "properties": {
-                        "year": {"type": "integer"},
-                        "month": {"type": "integer"},
-                        "day": {"type": "integer"}
-                        }
-                    },
-                    "title": {"type": "text"},
-                    "container-title": {"type": "text"},
-                    "volume": {"type": "integer"},
-                    "issue": {"type": "integer"},
-                    "page": {"type": "text"},
-                    "indexed": {
-                        "type": "object",
-                        "properties": {
-                        "year": {"type": "integer"},
-                        "month": {"type": "integer"},
-                        "day": {"type": "integer"}
-                        }
-                    },
-                    "abstract": {"type": "text"},
-                    "is-referenced-by-count": {"type": "integer"},
-                    "text-type": {"type": "keyword"},
-                    "ISSN": {"type": "keyword"}
+                        "published": {"type": "object", "properties": {"year": {"type": "integer"}}},
+                        "is-referenced-by-count": {"type": "integer"},
+                        "ISSN": {"type": "keyword"},
+                        "text-type": {"type": "keyword"},
+                        "topics": {"type": "keyword"}
                     }
                 }
             }
@@ -334,47 +1036,79 @@ def elasticsearch_mappings() -> dict[str]:
     }
 
 
-def form_query(query: str, num_results: int) -> dict[str]:
-    """Forms an Elasticsearch vector search query by embedding the given query string
+def paper_mappings() -> dict[str]:
+    """Get mappings schema of the paper metadata index in the flat layout
+
+    Returns
+    -------
+    dict of str
+        Mappings dictionary describing the Elasticsearch schema that accepts paper metadata documents.
+
+    """
+    return {
+        "mappings": {
+            "properties": {
+                "metadata": _metadata_mapping()
+            }
+        }
+    }
+
+
+def filterable_metadata(metadata: dict[str]) -> dict[str]:
+    """Gets the paper metadata that searches filter on, as copied into every sentence of the flat layout.
+
     Parameters
     ----------
-    query : str
-        A user-submitted string to embed into a vector and search for similar sentences with
-    num_results : int
-        The number of closest documents to return
+    metadata : dict of str
+        Metadata of a paper as yielded by get_documents.
 
     Returns
     -------
     dict of str
-        A query for Elasticsearch
+        Publication year, citation count, ISSNs, text type and topics of the paper.
     """
+    return {
+        "published": {"year": metadata.get("published", {}).get("year")},
+        "is-referenced-by-count": metadata.get("is-referenced-by-count"),
+        "ISSN": metadata.get("ISSN"),
+        "text-type": metadata.get("text-type"),
+        "topics": metadata.get("topics", [])
+    }
 
-    embeddings = model.encode(query)
 
-    return {
-      "knn": {
-        "field": "embedded_paper.vector",
-        "query_vector": embeddings,
-        "k": num_results,
-        "num_candidates": 200,
-        "inner_hits": {
-          "_source": False,
-          "fields": ["embedded_paper.title-and-sentence"],
-          "size": 1
+def flatten_document(doc: dict[str]) -> Iterator[dict[str]]:
+    """Splits a paper document into one document per sentence for the flat layout.
+
+    Parameters
+    ----------
+    doc : dict of str
+        Document of metadata and vectors as yielded by get_documents.
+
+    Yields
+    ------
+    dict of str
+        Document of the next sentence, its vector, its position in the abstract, the DOI of its paper and the
+        paper metadata that searches filter on.
+    """
+    doi = doc["metadata"]["DOI"]
+    filterable = filterable_metadata(doc["metadata"])
+    for position, embedded in enumerate(doc["embedded_paper"]):
+        yield {
+            "doi": doi,
+            "position": position,
+            "title-and-sentence": embedded["title-and-sentence"],
+            "vector": embedded["vector"],
+            "metadata": filterable
         }
-      }
-    }
 
 
 if __name__ == '__main__':
 
+    # Documents are streamed to float16 vector shards with JSON Lines sidecars, see shards.py
     docs = get_documents("food", 1000, 500, do_print=True)
-    write_list = []
-    for d in docs:
-        write_list.append(d)
-
-    with open("collected.json", 'w', encoding='UTF-8') as file:
-        json.dump(write_list, file, indent=2)
+    with ShardWriter("collected") as writer:
+        for d in docs:
+            writer.write(d)
 
 
 #     ret_dict = {}
@@ -0,0 +1,93 @@
+import hashlib
+from typing import Iterable
+
+import numpy as np
+
+
+class DoiSet:
+    """Set of DOIs that switches to a compact sorted array of hashes once it grows large.
+
+    Small sets are kept as a plain set of lowercased DOIs. Past `compact_after` DOIs, each DOI is kept only as a
+    64-bit hash in a sorted NumPy array, about 8 bytes per DOI instead of the 100 or so of a Python string, and
+    looked up by binary search. New hashes wait in a small set and are merged into the array in bulk. With 64-bit
+    hashes the chance of any collision among ten million DOIs is around one in a million, and a collision only
+    means a paper is wrongly skipped.
+
+    Not thread safe. DOIs are compared case-insensitively, as DOIs are.
+
+    Parameters
+    ----------
+    dois : Iterable of str
+        DOIs to start with.
+    compact_after : int
+        Number of DOIs above which the set is stored as hashes.
+    """
+
+    def __init__(self, dois: Iterable[str] = (), compact_after: int = 100_000):
+        self.compact_after = compact_after
+        self._exact = set()  # Lowercased DOIs, while the set is small
+        self._hashes = None  # Sorted uint64 hashes, once the set is compact
+        self._pending = set()  # Hashes added since the last merge into _hashes
+        self._size = 0
+        self.update(dois)
+
+    @staticmethod
+    def _hash(doi: str) -> int:
+        return int.from_bytes(hashlib.blake2b(doi.lower().encode("utf-8"), digest_size=8).digest(), "little")
+
+    def __contains__(self, doi: str) -> bool:
+        if self._hashes is None:
+            return doi.lower() in self._exact
+        h = self._hash(doi)
+        if h in self._pending:
+            return True
+        i = np.searchsorted(self._hashes, np.uint64(h))
+        return i < len(self._hashes) and int(self._hashes[i]) == h
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, doi: str) -> bool:
+        """Adds a DOI to the set.
+
+        Parameters
+        ----------
+        doi : str
+            DOI to add.
+
+        Returns
+        -------
+        bool
+            True if the DOI was not in the set before, False if it was already seen.
+        """
+        if doi in self:
+            return False
+
+        if self._hashes is None:
+            self._exact.add(doi.lower())
+            if len(self._exact) > self.compact_after:
+                self._compact()
+        else:
+            self._pending.add(self._hash(doi))
+            # Merging costs a pass over the array, so the pending set grows with it to keep adds cheap on average
+            if len(self._pending) >= max(4096, len(self._hashes) // 16):
+                self._merge()
+        self._size += 1
+        return True
+
+    def update(self, dois: Iterable[str]):
+        """Adds every DOI of an iterable to the set."""
+        for doi in dois:
+            self.add(doi)
+
+    def _compact(self):
+        # Replace the exact set with its hashes
+        self._hashes = np.empty(0, dtype=np.uint64)
+        self._pending = {self._hash(doi) for doi in self._exact}
+        self._exact = set()
+        self._merge()
+
+    def _merge(self):
+        pending = np.fromiter(self._pending, dtype=np.uint64, count=len(self._pending))
+        self._hashes = np.union1d(self._hashes, pending)
+        self._pending = set()
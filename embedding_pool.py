@@ -0,0 +1,109 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import numpy as np
+
+# Model of the worker process, loaded once by _init_worker
+_worker_model = None
+
+
+def _init_worker(threads: int, next_core, cores_per_worker: int, backend: str, quantize: str, model_name: str):
+    # Runs once in every worker process, before any batch
+    global _worker_model
+    if next_core is not None and hasattr(os, "sched_setaffinity"):
+        # Give each worker its own block of cores so that workers do not compete for them
+        with next_core.get_lock():
+            first = next_core.value
+            next_core.value += cores_per_worker
+        available = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, {available[(first + i) % len(available)] for i in range(cores_per_worker)})
+
+    # Limit the math libraries to the worker's share of the cores. Set before they are first loaded
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[var] = str(threads)
+    import torch
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+
+    from encoders import load_encoder
+    _worker_model = load_encoder(backend, quantize, model_name)
+
+
+def _encode(texts: list[str]) -> tuple[np.ndarray, float]:
+    # Embeds one batch in a worker process and reports how long the model took
+    start = time.perf_counter()
+    vectors = _worker_model.encode(texts, batch_size=len(texts), convert_to_numpy=True)
+    return vectors.astype(np.float32, copy=False), time.perf_counter() - start
+
+
+class EmbeddingPool:
+    """Pool of worker processes, each holding its own copy of the embedding model.
+
+    A single process only gets so far on a many-core machine, since much of encoding runs single threaded between
+    the matrix products. Spreading batches over processes with a few threads each scales far better. Workers are
+    started with spawn, so scripts using the pool must guard their entry point with `if __name__ == "__main__":`.
+    Every worker is started and loads its model in the background as soon as the pool is created, so the caller can
+    fetch and parse the first papers meanwhile.
+
+    Parameters
+    ----------
+    workers : int
+        Number of worker processes.
+    threads : int, optional
+        Number of math library threads of each worker. Defaults to the available cores divided by workers.
+    pin_cores : bool
+        Whether to bind each worker to its own block of `threads` cores. Linux only, ignored elsewhere.
+    backend : str, optional
+        Encoder backend of the workers, see encoders.load_encoder.
+    quantize : str, optional
+        Quantization config of the ONNX model, see encoders.load_encoder.
+    model_name : str, optional
+        Model to load, see encoders.load_encoder.
+    """
+
+    def __init__(self, workers: int, threads: int = None, pin_cores: bool = False, backend: str = None,
+                 quantize: str = None, model_name: str = None):
+        cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+        self.workers = workers
+        self.threads = threads or max(1, cores // workers)
+        # Batches waiting or being encoded at once. Two per worker keeps every worker busy without holding many
+        # batches in memory
+        self.max_in_flight = workers * 2
+
+        # spawn, since forking a process that has already loaded PyTorch or ONNX Runtime can deadlock
+        context = multiprocessing.get_context("spawn")
+        next_core = context.Value("i", 0) if pin_cores else None
+        self._executor = ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker,
+                                             initargs=(self.threads, next_core, self.threads, backend, quantize,
+                                                       model_name))
+        # The executor only starts a worker when a task finds none idle. Queueing one small batch per worker starts
+        # them all now, and the batch also runs the model once before the first real one. Nothing waits on them
+        for _ in range(workers):
+            self._executor.submit(_encode, ["warm up"])
+
+    def submit(self, texts: list[str]) -> Future:
+        """Queues a batch of texts to be embedded by the next free worker.
+
+        Parameters
+        ----------
+        texts : list of str
+            Texts to embed with one call to the model.
+
+        Returns
+        -------
+        Future
+            Resolves to the float32 array of one vector per text, in order, and the seconds the model took.
+        """
+        return self._executor.submit(_encode, texts)
+
+    def close(self):
+        """Cancels batches that have not started and stops the workers once the running ones are done."""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self) -> "EmbeddingPool":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,91 @@
+import os
+
+MODEL_NAME = os.getenv("ENCODER_MODEL", "all-MiniLM-L6-v2")
+# How the model is run: "torch" for PyTorch in fp32 or "onnx" for ONNX Runtime
+ENCODER_BACKEND = os.getenv("ENCODER_BACKEND", "torch")
+# Int8 dynamic quantization of the ONNX model: "none", "arm64", "avx2", "avx512" or "avx512_vnni"
+ENCODER_QUANTIZE = os.getenv("ENCODER_QUANTIZE", "none")
+
+QUANTIZE_CONFIGS = ("arm64", "avx2", "avx512", "avx512_vnni")
+
+
+def onnx_file_name(quantize: str = "none") -> str:
+    """Gets the file name of an ONNX export of the model, as laid out by sentence-transformers.
+
+    Parameters
+    ----------
+    quantize : str
+        Quantization config the file was exported with, or "none" for the unquantized model.
+
+    Returns
+    -------
+    str
+        Path of the ONNX file within the model directory.
+    """
+    if quantize == "none":
+        return "onnx/model.onnx"
+    if quantize not in QUANTIZE_CONFIGS:
+        raise ValueError(f"Unknown quantization config {quantize!r}, expected one of {QUANTIZE_CONFIGS}")
+    # AVX2 has no signed int8 VNNI instructions, so it is quantized to unsigned int8
+    dtype = "quint8" if quantize == "avx2" else "qint8"
+    return f"onnx/model_{dtype}_{quantize}.onnx"
+
+
+def load_encoder(backend: str = None, quantize: str = None, model_name: str = None):
+    """Loads the sentence embedding model on the configured backend.
+
+    Both backends produce the same normalized 384 dimensional vectors and share the encode() interface, so they
+    are interchangeable for indexing and querying. Defaults come from the ENCODER_MODEL, ENCODER_BACKEND and
+    ENCODER_QUANTIZE environment variables.
+
+    Parameters
+    ----------
+    backend : str, optional
+        "torch" or "onnx".
+    quantize : str, optional
+        Quantization config of the ONNX model to load, or "none". Ignored for the torch backend.
+    model_name : str, optional
+        Model name on the Hugging Face hub, or a local directory such as one written by export_quantized.
+
+    Returns
+    -------
+    SentenceTransformer
+        The loaded model.
+    """
+    # Imported here since importing sentence_transformers alone takes seconds
+    from sentence_transformers import SentenceTransformer
+
+    backend = backend or ENCODER_BACKEND
+    quantize = quantize or ENCODER_QUANTIZE
+    model_name = model_name or MODEL_NAME
+
+    if backend == "torch":
+        return SentenceTransformer(model_name)
+    if backend == "onnx":
+        return SentenceTransformer(model_name, backend="onnx", model_kwargs={"file_name": onnx_file_name(quantize)})
+    raise ValueError(f"Unknown encoder backend {backend!r}, expected 'torch' or 'onnx'")
+
+
+def export_quantized(output_dir: str, quantize: str = "avx512_vnni", model_name: str = None) -> str:
+    """Exports the model to ONNX with an int8 dynamically quantized copy, for machines without hub access.
+
+    Parameters
+    ----------
+    output_dir : str
+        Directory to write the model to. Pass it as model_name to load_encoder afterwards.
+    quantize : str
+        Quantization config matching the instruction set of the serving CPUs.
+    model_name : str, optional
+        Model name on the Hugging Face hub.
+
+    Returns
+    -------
+    str
+        Path of the quantized ONNX file within output_dir.
+    """
+    from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+
+    model = SentenceTransformer(model_name or MODEL_NAME, backend="onnx")
+    model.save_pretrained(output_dir)
+    export_dynamic_quantized_onnx_model(model, quantize, output_dir)
+    return onnx_file_name(quantize)
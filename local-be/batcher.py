@@ -0,0 +1,112 @@
+import asyncio
+from concurrent.futures import Executor
+from typing import Callable
+
+
+class MicroBatcher:
+    """Gathers queries that arrive close together and encodes them with a single call to the model.
+
+    A batch is started as soon as an encoding worker is free. It takes every query already waiting, then keeps
+    collecting for up to `window_ms` or until `max_batch` queries are gathered. Under load the workers stay
+    busy and batches grow on their own, while a lone query waits at most one window.
+
+    Parameters
+    ----------
+    encode : Callable
+        Function embedding a list of texts into a list of vectors. Run on the executor.
+    executor : Executor
+        Pool that batches are encoded on.
+    workers : int
+        Number of batches encoded at once. Should match the size of the executor.
+    max_batch : int
+        Maximum number of queries encoded in one call.
+    window_ms : float
+        Milliseconds to keep collecting queries after the first one of a batch arrives.
+    """
+
+    def __init__(self, encode: Callable[[list[str]], list[list[float]]], executor: Executor, workers: int = 1,
+                 max_batch: int = 32, window_ms: float = 2.0):
+        self.encode_batch = encode
+        self.executor = executor
+        self.workers = workers
+        self.max_batch = max_batch
+        self.window = window_ms / 1000
+        self.batches = 0
+        self.queries = 0
+        self._queue = None
+        self._task = None
+
+    def start(self):
+        """Starts collecting batches. Must be called from the running event loop."""
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stops collecting batches. Queries still waiting are cancelled."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        while self._queue is not None and not self._queue.empty():
+            self._queue.get_nowait()[1].cancel()
+
+    async def encode(self, text: str) -> list[float]:
+        """Embeds one query as part of the next batch.
+
+        Parameters
+        ----------
+        text : str
+            Query text to embed.
+
+        Returns
+        -------
+        list of float
+            Embedding vector of the query.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        free_workers = asyncio.Semaphore(self.workers)
+        while True:
+            # Wait for a free worker first so that queries keep piling up while all of them are busy
+            await free_workers.acquire()
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            task = asyncio.create_task(self._encode(batch))
+            task.add_done_callback(lambda _: free_workers.release())
+
+    async def _encode(self, batch: list[tuple[str, asyncio.Future]]):
+        # Identical queries in a batch are only encoded once
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        self.batches += 1
+        self.queries += len(batch)
+        try:
+            vectors = await asyncio.get_running_loop().run_in_executor(self.executor, self.encode_batch, texts)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        by_text = dict(zip(texts, vectors))
+        for text, future in batch:
+            # The request may have been cancelled while waiting
+            if not future.done():
+                future.set_result(by_text[text])
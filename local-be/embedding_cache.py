@@ -0,0 +1,60 @@
+import threading
+import unicodedata
+from collections import OrderedDict
+
+
+class EmbeddingCache:
+    """Bounded LRU cache of query embeddings with hit and miss counters.
+
+    Parameters
+    ----------
+    max_size : int
+        Maximum number of embeddings kept. The least recently used one is dropped past this.
+    """
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Normalizes query text into a cache key.
+
+        The model's tokenizer is uncased and ignores whitespace, so texts that only differ in case, spacing or
+        unicode composition have the same embedding.
+        """
+        return " ".join(unicodedata.normalize("NFC", text).split()).lower()
+
+    def get(self, key: str) -> list[float] | None:
+        """Looks up the embedding for a normalized key, counting a hit or a miss."""
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return vector
+
+    def put(self, key: str, vector: list[float]):
+        """Stores the embedding for a normalized key, evicting the least recently used one if full."""
+        with self._lock:
+            self._entries[key] = vector
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict[str, float]:
+        """Gets the size of the cache and its hit and miss counts."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
@@ -1,15 +1,96 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from elasticsearch import Elasticsearch
+from pydantic import BaseModel, Field
+from fastapi.responses import JSONResponse, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from elasticsearch import AsyncElasticsearch
 from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import asyncio
 import os
-from collect_documents import form_query
+import time
+from batcher import MicroBatcher
+from metrics import ERRORS, REQUESTS, REQUEST_SECONDS, STAGE_SECONDS, register_stats
+from query import MAX_NUM_CANDIDATES, encode_queries, get_model, knn_filter, knn_query, query_cache
+from search_backends import ElasticsearchBackend, NumpyBackend
 
 # Load .env if available.
 load_dotenv()
 
-app = FastAPI()
+# Load environment variables.
+ELASTIC_PASSWORD = os.getenv("ELASTIC_PASSWORD", "password")
+ELASTICSEARCH_HOST = os.getenv("ELASTICSEARCH_HOST", "http://elasticsearch:9200")
+# Number of threads encoding queries at once. The model releases the GIL, so these run in parallel.
+ENCODE_WORKERS = int(os.getenv("ENCODE_WORKERS", "2"))
+# Queries arriving within this many milliseconds of each other are encoded together, up to the maximum batch size.
+QUERY_BATCH_WINDOW_MS = float(os.getenv("QUERY_BATCH_WINDOW_MS", "2"))
+QUERY_BATCH_MAX = int(os.getenv("QUERY_BATCH_MAX", "32"))
+# Largest number of queries accepted by one call to /search/vector/batch.
+BATCH_SEARCH_MAX = int(os.getenv("BATCH_SEARCH_MAX", "1000"))
+
+# Initialize elasticsearch connection.
+es = AsyncElasticsearch(ELASTICSEARCH_HOST, basic_auth=("elastic", ELASTIC_PASSWORD), verify_certs=False)
+
+# Encoding is CPU bound, so it runs on a bounded pool instead of the event loop.
+encode_pool = ThreadPoolExecutor(max_workers=ENCODE_WORKERS, thread_name_prefix="encode")
+
+# Concurrent queries are gathered into batches and encoded with one call to the model.
+batcher = MicroBatcher(encode_queries, encode_pool, workers=ENCODE_WORKERS, max_batch=QUERY_BATCH_MAX,
+                       window_ms=QUERY_BATCH_WINDOW_MS)
+register_stats(query_cache, batcher)
+
+# "nested" searches the index of papers with nested sentences, "flat" the index with one document per sentence.
+INDEX_LAYOUT = os.getenv("INDEX_LAYOUT", "nested")
+INDEX_NAME = os.getenv("INDEX_NAME", "research_papers" if INDEX_LAYOUT == "nested" else "research_sentences")
+# "elasticsearch", or "numpy" to search vector shards in SHARD_DIR exactly without a cluster.
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "elasticsearch")
+SHARD_DIR = os.getenv("SHARD_DIR", "collected")
+SEARCH_WORKERS = int(os.getenv("SEARCH_WORKERS", "2"))
+
+if SEARCH_BACKEND == "numpy":
+    backend = NumpyBackend(SHARD_DIR, ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix="search"),
+                           INDEX_LAYOUT)
+else:
+    backend = ElasticsearchBackend(es, INDEX_NAME, INDEX_LAYOUT)
+
+# Set once the model is loaded and a first search has gone through, see /ready.
+ready = asyncio.Event()
+
+
+# Loads the model and runs a dummy encode and kNN search so that the first real request is not slow.
+# Retries until the search backend can be reached.
+async def warmup():
+    loop = asyncio.get_running_loop()
+    # Warm every encoding thread, since each one sets up its own state on first use.
+    await loop.run_in_executor(encode_pool, get_model)
+    vectors = await asyncio.gather(*[loop.run_in_executor(encode_pool, encode_queries, ["warmup"])
+                                     for _ in range(ENCODE_WORKERS)])
+    vector = vectors[0][0]
+    while True:
+        try:
+            await backend.warmup(vector)
+            break
+        except Exception as e:
+            print(f"Warmup search failed, retrying: {e}")
+            await asyncio.sleep(5)
+    ready.set()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    batcher.start()
+    warmup_task = asyncio.create_task(warmup())
+    yield
+    # Release connections and encoding threads on shutdown.
+    warmup_task.cancel()
+    await batcher.stop()
+    await backend.close()
+    await es.close()
+    encode_pool.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Allow frontend access.
 app.add_middleware(
@@ -20,33 +101,87 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Load environment variables.
-ELASTIC_PASSWORD = os.getenv("ELASTIC_PASSWORD", "password")
-ELASTICSEARCH_HOST = os.getenv("ELASTICSEARCH_HOST", "http://elasticsearch:9200")
+# Counts and times every request by route, so that metrics do not grow with the values in paths.
+@app.middleware("http")
+async def record_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        endpoint = route.path if route is not None else "unmatched"
+        REQUEST_SECONDS.labels(endpoint, request.method).observe(time.perf_counter() - start)
+        REQUESTS.labels(endpoint, request.method, str(status)).inc()
+        if status >= 500:
+            ERRORS.labels(endpoint, request.method).inc()
 
-# Initialize elasticsearch connection.
-es = Elasticsearch(ELASTICSEARCH_HOST, basic_auth=("elastic", ELASTIC_PASSWORD), verify_certs=False)
+# Options shared by single and batch vector search.
+# The optional filters restrict the search to matching papers, see query.knn_filter.
+class SearchOptions(BaseModel):
+    top_k: int = Field(10, ge=1, le=MAX_NUM_CANDIDATES)
+    year_from: int | None = None
+    year_to: int | None = None
+    min_citations: int | None = None
+    issn: list[str] | None = None
+    text_type: list[str] | None = None
+    topic: list[str] | None = None
 
-# Placeholder Index (.env variable?).
-INDEX_NAME = "research_papers"
+    def filters(self) -> dict:
+        return self.model_dump(include={"year_from", "year_to", "min_citations", "issn", "text_type", "topic"},
+                               exclude_none=True)
 
 # Request schema for vector search.
-class SearchRequest(BaseModel):
+class SearchRequest(SearchOptions):
     text: str
-    top_k: int = 10
+
+# Request schema for batch vector search. The options apply to every query.
+class BatchSearchRequest(SearchOptions):
+    texts: list[str] = Field(min_length=1, max_length=BATCH_SEARCH_MAX)
+
+# Embeds query text without blocking the event loop. Cached embeddings are returned directly.
+async def embed_query(text: str) -> list[float]:
+    with STAGE_SECONDS.labels("encode").time():
+        key = query_cache.normalize(text)
+        vector = query_cache.get(key)
+        if vector is None:
+            vector = await batcher.encode(text)
+            query_cache.put(key, vector)
+        return vector
+
+# Embeds many query texts with a single call to the model on the encoding pool.
+# Cached embeddings are reused and repeated texts are only encoded once.
+async def embed_queries(texts: list[str]) -> list[list[float]]:
+    with STAGE_SECONDS.labels("encode").time():
+        keys = [query_cache.normalize(text) for text in texts]
+        vectors = {key: query_cache.get(key) for key in keys}
+        missing = {key: text for key, text in zip(keys, texts) if vectors[key] is None}
+        if missing:
+            loop = asyncio.get_running_loop()
+            encoded = await loop.run_in_executor(encode_pool, encode_queries, list(missing.values()))
+            for key, vector in zip(missing, encoded):
+                vectors[key] = vector
+                query_cache.put(key, vector)
+        return [vectors[key] for key in keys]
 
 # Copy of below, utilized to test raw hit format from ES.
+# Also reports how long the search took according to Elasticsearch and as measured here.
 @app.post("/search/vector/test")
 async def vector_search_test(request: SearchRequest):
+    if SEARCH_BACKEND != "elasticsearch":
+        raise HTTPException(status_code=404, detail="Raw hits are only available from Elasticsearch.")
     try:
-        query = form_query(request.text, request.top_k)
-        response = es.search(index=INDEX_NAME, body=query)
+        query = knn_query(await embed_query(request.text), request.top_k, INDEX_LAYOUT,
+                          filters=knn_filter(**request.filters()))
+        start = time.perf_counter()
+        response = await es.search(index=INDEX_NAME, body=query)
+        timing = {"took_ms": response["took"], "wall_ms": (time.perf_counter() - start) * 1000}
         if response["hits"]["hits"]:
-            first_hit = response["hits"]["hits"][0]
-            print("First Elasticsearch hit:\n", first_hit)
-            return {"raw_first_hit": first_hit}
+            return {"raw_first_hit": response["hits"]["hits"][0], **timing}
         else:
-            return {"message": "No hits found."}
+            return {"message": "No hits found.", **timing}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -56,30 +191,55 @@ async def vector_search_test(request: SearchRequest):
 @app.post("/search/vector")
 async def vector_search(request: SearchRequest):
     try:
-        # Formats as elastic search body and encodes the search request text to a vector.
-        query = form_query(request.text, request.top_k)
-        response = es.search(index=INDEX_NAME, body=query)
-        results = []
-        # Loops over the returned hits.
-        for hit in response["hits"]["hits"]:
-            # Access inner hits for embedded paper data.
-            embedded_paper_hits = hit.get("inner_hits", {}).get("embedded_paper", {}).get("hits", {}).get("hits", [])
-            # For each embedded hit...
-            for embedded_hit in embedded_paper_hits:
-                title_and_sentence = embedded_hit.get("fields", {}).get("embedded_paper", [{}])[0].get("title-and-sentence", [])
-                # If there is data for the title-and-sentence...
-                if title_and_sentence:
-                    # Append relevant data to result.
-                    results.append({
-                        "doi": hit["_source"].get("metadata", {}).get("DOI", None),
-                        "sentence": title_and_sentence[0],
-                        "score": hit["_score"]
-                    })
+        # Encodes the search request text to a vector and searches the configured backend with it.
+        results = await backend.search(await embed_query(request.text), request.top_k, request.filters())
 
         return {"results": results}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# Batch Vector Search utilizes a request of type BatchSearchRequest.
+# Encodes all queries with one call to the model and searches for them with one request to the backend.
+# Returns the results of every query, in the order of the queries.
+@app.post("/search/vector/batch")
+async def vector_search_batch(request: BatchSearchRequest):
+    try:
+        vectors = await embed_queries(request.texts)
+        results = await backend.search_many(vectors, request.top_k, request.filters())
+
+        return {"results": [{"text": text, "results": r} for text, r in zip(request.texts, results)]}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Readiness check. Only reports ready once warmup has finished, so traffic is not sent to a cold server.
+@app.get("/ready")
+async def readiness():
+    if not ready.is_set():
+        return JSONResponse(status_code=503, content={"ready": False})
+    return {"ready": True}
+
+# Prometheus metrics: request counts, errors and latency per endpoint, latency of each search stage,
+# Elasticsearch took against wall-clock time, and query cache and batcher counters.
+@app.get("/metrics")
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+# Reports how often query embeddings are served from the cache.
+@app.get("/cache/stats")
+async def cache_stats():
+    return query_cache.stats()
+
+# Reports how many queries were encoded and in how many batches.
+@app.get("/batch/stats")
+async def batch_stats():
+    return {
+        "batches": batcher.batches,
+        "queries": batcher.queries,
+        "mean_batch_size": batcher.queries / batcher.batches if batcher.batches else 0.0,
+        "window_ms": QUERY_BATCH_WINDOW_MS,
+        "max_batch": QUERY_BATCH_MAX
+    }
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run("main:app", host="0.0.0.0", port=8000)
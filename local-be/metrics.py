@@ -0,0 +1,57 @@
+from prometheus_client import Counter, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.registry import REGISTRY
+
+# Latency buckets in seconds, fine grained below 100 ms where encoding and kNN search usually land
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REQUESTS = Counter("http_requests_total", "HTTP requests handled.", ["endpoint", "method", "status"])
+ERRORS = Counter("http_request_errors_total", "HTTP requests that failed with a server error.",
+                 ["endpoint", "method"])
+REQUEST_SECONDS = Histogram("http_request_duration_seconds", "Wall-clock time to answer an HTTP request.",
+                            ["endpoint", "method"], buckets=LATENCY_BUCKETS)
+
+# Time spent in each stage of a search: "encode" embeds the query text, including any wait for a batch,
+# "search" is the call to the search backend and "postprocess" turns its response into results.
+STAGE_SECONDS = Histogram("search_stage_duration_seconds", "Time spent in each stage of a search.", ["stage"],
+                          buckets=LATENCY_BUCKETS)
+
+# Elasticsearch's own timing of a search against the wall-clock time of the request. A large gap points at the
+# network, the client or queueing in front of the cluster rather than at the search itself.
+ES_TOOK_SECONDS = Histogram("elasticsearch_took_seconds", "Search time reported by Elasticsearch in took.",
+                            ["operation"], buckets=LATENCY_BUCKETS)
+ES_WALL_SECONDS = Histogram("elasticsearch_wall_seconds", "Wall-clock time of search requests to Elasticsearch.",
+                            ["operation"], buckets=LATENCY_BUCKETS)
+
+
+class _StatsCollector:
+    # Reports the counters the query cache and batcher already keep, read at scrape time
+    def __init__(self, cache, batcher):
+        self.cache = cache
+        self.batcher = batcher
+
+    def collect(self):
+        stats = self.cache.stats()
+        yield CounterMetricFamily("query_cache_hits", "Query embeddings served from the cache.",
+                                  value=stats["hits"])
+        yield CounterMetricFamily("query_cache_misses", "Query embeddings not found in the cache.",
+                                  value=stats["misses"])
+        yield GaugeMetricFamily("query_cache_hit_ratio", "Share of query cache lookups that were hits.",
+                                value=stats["hit_rate"])
+        yield GaugeMetricFamily("query_cache_entries", "Query embeddings held in the cache.", value=stats["size"])
+        yield CounterMetricFamily("query_batches", "Batches of queries encoded.", value=self.batcher.batches)
+        yield CounterMetricFamily("query_batched_queries", "Queries encoded through the batcher.",
+                                  value=self.batcher.queries)
+
+
+def register_stats(cache, batcher):
+    """Exposes the hit and miss counts of an EmbeddingCache and the batch counts of a MicroBatcher as metrics.
+
+    Parameters
+    ----------
+    cache : EmbeddingCache
+        Cache of query embeddings.
+    batcher : MicroBatcher
+        Batcher that encodes queries.
+    """
+    REGISTRY.register(_StatsCollector(cache, batcher))
@@ -0,0 +1,189 @@
+import numpy as np
+
+from shards import load_vectors, read_jsonl, read_manifest
+
+
+class NumpySearch:
+    """Exact cosine similarity search over the vector shards written by ShardWriter, without Elasticsearch.
+
+    Vectors stay memory-mapped on disk and are scanned in blocks, so only one block at a time is converted to
+    float32. Every block is scored against all queries at once with a single matrix product. Results have the
+    same DOI/sentence/score shape as the Elasticsearch search, and scores use Elasticsearch's cosine scale of
+    (1 + cosine) / 2, so the two backends can be swapped and compared directly.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of vector shards.
+    block_rows : int
+        Number of vectors scored per matrix product. Bounds the float32 working memory to block_rows x dims.
+    """
+
+    def __init__(self, directory: str, block_rows: int = 65536):
+        self.block_rows = block_rows
+        self.shards = []  # Memory-mapped vectors of every shard
+        self.inverse_norms = []  # 1 / norm of every vector of every shard, so stored vectors need not be unit length
+        self.dois = []
+        self.sentences = []
+        # Metadata searches can filter on, per paper, and the paper of every row
+        self.paper_years = []
+        self.paper_citations = []
+        self.paper_issns = []
+        self.paper_types = []
+        self.paper_topics = []
+        row_papers = []
+
+        for shard in read_manifest(directory)["shards"]:
+            vectors = load_vectors(directory, shard["name"])
+            norms = np.empty(len(vectors), dtype=np.float32)
+            for start in range(0, len(vectors), block_rows):
+                block = np.asarray(vectors[start:start + block_rows], dtype=np.float32)
+                norms[start:start + block_rows] = np.linalg.norm(block, axis=1)
+            self.shards.append(vectors)
+            self.inverse_norms.append(1 / np.maximum(norms, 1e-12))
+
+            for sentence in read_jsonl(directory, "sentences", shard["name"]):
+                self.dois.append(sentence["doi"])
+                self.sentences.append(sentence["title-and-sentence"])
+
+            for paper in read_jsonl(directory, "papers", shard["name"]):
+                metadata = paper["metadata"]
+                row_papers.append(np.full(paper["end"] - paper["start"], len(self.paper_years), dtype=np.int32))
+                self.paper_years.append(metadata.get("published", {}).get("year") or -1)
+                self.paper_citations.append(metadata.get("is-referenced-by-count") or 0)
+                self.paper_issns.append(set(metadata.get("ISSN") or []))
+                self.paper_types.append(metadata.get("text-type"))
+                self.paper_topics.append(set(metadata.get("topics") or []))
+
+        self.size = len(self.dois)
+        self.row_papers = np.concatenate(row_papers) if row_papers else np.empty(0, dtype=np.int32)
+        self.paper_years = np.asarray(self.paper_years, dtype=np.int32)
+        self.paper_citations = np.asarray(self.paper_citations, dtype=np.int32)
+
+    def mask(self, year_from: int = None, year_to: int = None, min_citations: int = None, issn: list[str] = None,
+             text_type: list[str] = None, topic: list[str] = None) -> np.ndarray | None:
+        """Gets which rows belong to papers matching the filters, with the same meaning as query.knn_filter.
+
+        Returns
+        -------
+        np.ndarray or None
+            Boolean array of one entry per row, or None if no filter is set.
+        """
+        papers = np.ones(len(self.paper_years), dtype=bool)
+        if year_from is not None:
+            papers &= self.paper_years >= year_from
+        if year_to is not None:
+            papers &= (self.paper_years <= year_to) & (self.paper_years >= 0)
+        if min_citations is not None:
+            papers &= self.paper_citations >= min_citations
+        if issn:
+            issn = set(issn)
+            papers &= np.fromiter((bool(i & issn) for i in self.paper_issns), dtype=bool, count=len(papers))
+        if text_type:
+            papers &= np.isin(np.asarray(self.paper_types, dtype=object), text_type)
+        if topic:
+            topic = set(topic)
+            papers &= np.fromiter((bool(t & topic) for t in self.paper_topics), dtype=bool, count=len(papers))
+        return None if papers.all() else papers[self.row_papers]
+
+    def top_k(self, queries: np.ndarray, k: int, mask: np.ndarray = None) -> tuple[np.ndarray, np.ndarray]:
+        """Finds the k most similar stored vectors of every query.
+
+        Parameters
+        ----------
+        queries : np.ndarray
+            Query vectors, one per row.
+        k : int
+            Number of neighbors to return per query.
+        mask : np.ndarray, optional
+            Boolean array of the rows that may be returned, see mask.
+
+        Returns
+        -------
+        tuple of np.ndarray
+            Global row numbers and cosine similarities of the neighbors, both of shape (queries, k), best first.
+            Excluded rows have a similarity of -inf and only show up when fewer than k rows match.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        k = min(k, self.size)
+
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        offset = 0
+        for vectors, inverse_norms in zip(self.shards, self.inverse_norms):
+            for start in range(0, len(vectors), self.block_rows):
+                block = np.asarray(vectors[start:start + self.block_rows], dtype=np.float32)
+                scores = (queries @ block.T) * inverse_norms[start:start + self.block_rows]
+                if mask is not None:
+                    scores[:, ~mask[offset + start:offset + start + len(block)]] = -np.inf
+
+                # Keep only the block's top k per query, then merge with the best found so far
+                if scores.shape[1] > k:
+                    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                    scores = np.take_along_axis(scores, top, axis=1)
+                else:
+                    top = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+                rows = top + offset + start
+
+                best_rows = np.concatenate([best_rows, rows], axis=1)
+                best_scores = np.concatenate([best_scores, scores], axis=1)
+                if best_scores.shape[1] > k:
+                    keep = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+                    best_rows = np.take_along_axis(best_rows, keep, axis=1)
+                    best_scores = np.take_along_axis(best_scores, keep, axis=1)
+            offset += len(vectors)
+
+        order = np.argsort(-best_scores, axis=1)
+        return np.take_along_axis(best_rows, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+    def search(self, queries: np.ndarray, k: int, per_paper: bool = True,
+               filters: dict[str] = None) -> list[list[dict[str]]]:
+        """Searches for the sentences most similar to every query.
+
+        Parameters
+        ----------
+        queries : np.ndarray
+            Query vectors, one per row.
+        k : int
+            Number of results per query.
+        per_paper : bool
+            Whether to return only the best sentence of each paper, like a search of the nested layout, rather than
+            the best sentences overall, like a search of the flat layout.
+        filters : dict of str, optional
+            Keyword arguments of mask restricting which papers are searched.
+
+        Returns
+        -------
+        list of list of dict of str
+            DOI, sentence and score of every result of every query, best first.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        mask = self.mask(**filters) if filters else None
+        if not per_paper:
+            rows, scores = self.top_k(queries, k, mask)
+            return [[self._result(r, s) for r, s in zip(rows[q], scores[q]) if np.isfinite(s)]
+                    for q in range(len(queries))]
+
+        # Papers have several sentences, so fetch more candidates for the queries that found fewer than k papers
+        results = [None] * len(queries)
+        pending = list(range(len(queries)))
+        candidates = k * 8
+        while pending:
+            rows, scores = self.top_k(queries[pending], candidates, mask)
+            missing = []
+            for i, q in enumerate(pending):
+                papers = {}
+                for r, s in zip(rows[i], scores[i]):
+                    if np.isfinite(s):
+                        papers.setdefault(self.dois[r], (r, s))
+                if len(papers) >= k or candidates >= self.size:
+                    results[q] = [self._result(r, s) for r, s in list(papers.values())[:k]]
+                else:
+                    missing.append(q)
+            pending = missing
+            candidates *= 4
+        return results
+
+    def _result(self, row: int, score: float) -> dict[str]:
+        return {"doi": self.dois[row], "sentence": self.sentences[row], "score": float((1 + score) / 2)}
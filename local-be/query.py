@@ -0,0 +1,254 @@
+import os
+import threading
+
+from embedding_cache import EmbeddingCache
+from encoders import load_encoder
+
+# The model is loaded on first use rather than at import, so the server starts without waiting for it
+_model = None
+_model_lock = threading.Lock()
+
+# Cache of query embeddings so that repeated queries skip the model
+query_cache = EmbeddingCache(int(os.getenv("QUERY_CACHE_SIZE", "10000")))
+
+# num_candidates of a kNN search grows with the number of results by this ratio, up to the cap
+NUM_CANDIDATES_RATIO = float(os.getenv("NUM_CANDIDATES_RATIO", "20"))
+NUM_CANDIDATES_CAP = int(os.getenv("NUM_CANDIDATES_CAP", "2000"))
+# Largest num_candidates, and so number of results, Elasticsearch accepts
+MAX_NUM_CANDIDATES = 10000
+
+
+def get_model():
+    """Gets the SentenceBERT model, loading it once on the first call.
+
+    Returns
+    -------
+    SentenceTransformer
+        The model used to embed queries, on the backend chosen by ENCODER_BACKEND (see encoders.py).
+    """
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                _model = load_encoder()
+    return _model
+
+
+def encode_queries(texts: list[str]) -> list[list[float]]:
+    """Embeds query strings with a single call to the model.
+
+    Parameters
+    ----------
+    texts : list of str
+        Query strings to embed.
+
+    Returns
+    -------
+    list of list of float
+        Embedding vector of each query, in order.
+    """
+    return get_model().encode(texts, batch_size=len(texts)).tolist()
+
+
+def encode_query(query: str) -> list[float]:
+    """Embeds a query string, reusing the cached embedding of an equivalent earlier query.
+
+    Parameters
+    ----------
+    query : str
+        A user-submitted string to embed into a vector.
+
+    Returns
+    -------
+    list of float
+        Embedding vector of the query.
+    """
+    key = query_cache.normalize(query)
+    embeddings = query_cache.get(key)
+    if embeddings is None:
+        embeddings = encode_queries([query])[0]
+        query_cache.put(key, embeddings)
+    return embeddings
+
+
+def num_candidates_for(top_k: int, ratio: float = NUM_CANDIDATES_RATIO, cap: int = NUM_CANDIDATES_CAP) -> int:
+    """Gets how many candidates each shard considers in a kNN search for top_k results.
+
+    More candidates raise recall at the cost of latency. The number grows with top_k by the given ratio up to the
+    cap, but is never below top_k, since Elasticsearch rejects a k above num_candidates, nor above
+    Elasticsearch's limit of 10000.
+
+    Parameters
+    ----------
+    top_k : int
+        Number of results requested.
+    ratio : float
+        Candidates per requested result.
+    cap : int
+        Maximum number of candidates, unless top_k itself is larger.
+
+    Returns
+    -------
+    int
+        The num_candidates of the search.
+    """
+    return min(max(min(int(top_k * ratio), cap), top_k), MAX_NUM_CANDIDATES)
+
+
+def knn_filter(year_from: int = None, year_to: int = None, min_citations: int = None, issn: list[str] = None,
+               text_type: list[str] = None, topic: list[str] = None) -> list[dict[str]]:
+    """Forms the pre-filters of a kNN search on paper metadata
+
+    Filters are applied while Elasticsearch walks the vector graph, so every returned result matches them rather
+    than being thrown away after the search.
+
+    Parameters
+    ----------
+    year_from : int, optional
+        Earliest publication year
+    year_to : int, optional
+        Latest publication year
+    min_citations : int, optional
+        Minimum number of times the paper is cited
+    issn : list of str, optional
+        ISSNs of the journals to search in
+    text_type : list of str, optional
+        Types of text to search in, such as "journal-article"
+    topic : list of str, optional
+        Topics to search in, as given to the uploader. A paper matches if it has any of them
+
+    Returns
+    -------
+    list of dict of str
+        Filter clauses, empty if no filter is set
+    """
+    filters = []
+    if year_from is not None or year_to is not None:
+        year = {}
+        if year_from is not None:
+            year["gte"] = year_from
+        if year_to is not None:
+            year["lte"] = year_to
+        filters.append({"range": {"metadata.published.year": year}})
+    if min_citations is not None:
+        filters.append({"range": {"metadata.is-referenced-by-count": {"gte": min_citations}}})
+    if issn:
+        filters.append({"terms": {"metadata.ISSN": issn}})
+    if text_type:
+        filters.append({"terms": {"metadata.text-type": text_type}})
+    if topic:
+        filters.append({"terms": {"metadata.topics": topic}})
+    return filters
+
+
+def form_query(query: str, num_results: int, layout: str = "nested") -> dict[str]:
+    """Forms an Elasticsearch vector search query by embedding the given query string
+    Parameters
+    ----------
+    query : str
+        A user-submitted string to embed into a vector and search for similar sentences with
+    num_results : int
+        The number of closest documents to return
+    layout : str
+        "nested" for the index of papers with nested sentences, "flat" for the index with one document per sentence
+
+    Returns
+    -------
+    dict of str
+        A query for Elasticsearch
+    """
+
+    return knn_query(encode_query(query), num_results, layout)
+
+
+def knn_query(embeddings: list[float], num_results: int, layout: str = "nested", num_candidates: int = None,
+              filters: list[dict[str]] = None) -> dict[str]:
+    """Forms an Elasticsearch vector search query from an already embedded query
+    Parameters
+    ----------
+    embeddings : list of float
+        Embedding vector of the query
+    num_results : int
+        The number of closest documents to return
+    layout : str
+        "nested" for the index of papers with nested sentences, "flat" for the index with one document per sentence
+    num_candidates : int, optional
+        Candidates considered per shard. Derived from num_results with num_candidates_for if not given
+    filters : list of dict of str, optional
+        Pre-filter clauses on paper metadata, see knn_filter
+
+    Returns
+    -------
+    dict of str
+        A query for Elasticsearch
+    """
+
+    knn = {
+      "field": "vector" if layout == "flat" else "embedded_paper.vector",
+      "query_vector": embeddings,
+      "k": num_results,
+      "num_candidates": num_candidates or num_candidates_for(num_results)
+    }
+    if filters:
+        knn["filter"] = filters
+
+    if layout == "flat":
+        # Sentences are documents of their own, so no inner hits are needed and a paper can match several times
+        return {
+          "knn": knn,
+          "_source": ["doi", "title-and-sentence"],
+          "size": num_results
+        }
+
+    knn["inner_hits"] = {
+      "_source": False,
+      "fields": ["embedded_paper.title-and-sentence"],
+      "size": 1
+    }
+    return {
+      "_source": ["metadata.DOI"],
+      "knn": knn,
+      "size": num_results
+    }
+
+
+def search_results(response: dict[str], layout: str = "nested") -> list[dict[str]]:
+    """Extracts the matching sentences from an Elasticsearch response to a knn_query
+    Parameters
+    ----------
+    response : dict of str
+        Response of the search
+    layout : str
+        Layout of the index that was searched, as passed to knn_query
+
+    Returns
+    -------
+    list of dict of str
+        DOI, sentence and score of every match, best first
+    """
+    results = []
+    # Loops over the returned hits.
+    for hit in response["hits"]["hits"]:
+        if layout == "flat":
+            results.append({
+                "doi": hit["_source"].get("doi"),
+                "sentence": hit["_source"].get("title-and-sentence"),
+                "score": hit["_score"]
+            })
+            continue
+
+        # Access inner hits for embedded paper data.
+        embedded_paper_hits = hit.get("inner_hits", {}).get("embedded_paper", {}).get("hits", {}).get("hits", [])
+        # For each embedded hit...
+        for embedded_hit in embedded_paper_hits:
+            title_and_sentence = embedded_hit.get("fields", {}).get("embedded_paper", [{}])[0].get("title-and-sentence", [])
+            # If there is data for the title-and-sentence...
+            if title_and_sentence:
+                # Append relevant data to result.
+                results.append({
+                    "doi": hit["_source"].get("metadata", {}).get("DOI", None),
+                    "sentence": title_and_sentence[0],
+                    "score": hit["_score"]
+                })
+
+    return results
@@ -0,0 +1,134 @@
+import asyncio
+import time
+from concurrent.futures import Executor
+
+from elasticsearch import AsyncElasticsearch, NotFoundError
+
+from metrics import ES_TOOK_SECONDS, ES_WALL_SECONDS, STAGE_SECONDS
+from query import knn_filter, knn_query, search_results
+
+
+class ElasticsearchBackend:
+    """Searches sentence vectors with Elasticsearch's approximate kNN search.
+
+    Parameters
+    ----------
+    es : AsyncElasticsearch
+        Client to search with.
+    index : str
+        Index to search.
+    layout : str
+        Layout of the index, "nested" or "flat".
+    """
+
+    def __init__(self, es: AsyncElasticsearch, index: str, layout: str = "nested"):
+        self.es = es
+        self.index = index
+        self.layout = layout
+
+    async def search(self, vector: list[float], top_k: int, filters: dict[str] = None) -> list[dict[str]]:
+        """Gets the DOI, sentence and score of the top_k results closest to a query vector, best first.
+
+        filters holds the keyword arguments of query.knn_filter, applied as kNN pre-filters.
+        """
+        query = knn_query(vector, top_k, self.layout, filters=knn_filter(**(filters or {})))
+        response = await self._timed("search", self.es.search(index=self.index, body=query))
+        with STAGE_SECONDS.labels("postprocess").time():
+            return search_results(response, self.layout)
+
+    async def search_many(self, vectors: list[list[float]], top_k: int,
+                          filters: dict[str] = None) -> list[list[dict[str]]]:
+        """Searches for several query vectors with a single multi search request.
+
+        Returns the results of every vector in order. Raises RuntimeError if any of the searches failed.
+        """
+        knn_filters = knn_filter(**(filters or {}))
+        searches = []
+        for vector in vectors:
+            searches.append({"index": self.index})
+            searches.append(knn_query(vector, top_k, self.layout, filters=knn_filters))
+
+        response = await self._timed("msearch", self.es.msearch(searches=searches))
+        with STAGE_SECONDS.labels("postprocess").time():
+            results = []
+            for item in response["responses"]:
+                if "error" in item:
+                    raise RuntimeError(item["error"])
+                results.append(search_results(item, self.layout))
+            return results
+
+    async def _timed(self, operation: str, request):
+        # Await a search request, recording its wall-clock time next to the time Elasticsearch reports in took
+        start = time.perf_counter()
+        response = await request
+        wall = time.perf_counter() - start
+        STAGE_SECONDS.labels("search").observe(wall)
+        ES_WALL_SECONDS.labels(operation).observe(wall)
+        ES_TOOK_SECONDS.labels(operation).observe(response["took"] / 1000)
+        return response
+
+    async def warmup(self, vector: list[float]):
+        """Runs a first search so that the index is loaded. A missing index has nothing to warm up."""
+        try:
+            await self.search(vector, 1)
+        except NotFoundError:
+            pass
+
+    async def close(self):
+        # The client is owned by whoever passed it in, so it is left open
+        pass
+
+
+class NumpyBackend:
+    """Searches sentence vectors exactly with NumPy, from vector shards on local disk.
+
+    Needs no Elasticsearch cluster, which suits small deployments and CI. Being exact, it is also the ground
+    truth that approximate search is measured against.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of vector shards written by ShardWriter.
+    executor : Executor
+        Pool that searches run on, since NumPy releases the GIL during matrix products.
+    layout : str
+        "nested" returns the best sentence of each paper, "flat" the best sentences overall, matching how each
+        Elasticsearch layout answers.
+    """
+
+    def __init__(self, directory: str, executor: Executor, layout: str = "nested"):
+        self.directory = directory
+        self.executor = executor
+        self.per_paper = layout == "nested"
+        self.engine = None
+
+    async def search(self, vector: list[float], top_k: int, filters: dict[str] = None) -> list[dict[str]]:
+        """Gets the DOI, sentence and score of the top_k results closest to a query vector, best first.
+
+        filters holds the keyword arguments of query.knn_filter, applied before scoring.
+        """
+        return (await self.search_many([vector], top_k, filters))[0]
+
+    async def search_many(self, vectors: list[list[float]], top_k: int,
+                          filters: dict[str] = None) -> list[list[dict[str]]]:
+        """Searches for several query vectors with one pass over the shards.
+
+        Returns the results of every vector in order.
+        """
+        loop = asyncio.get_running_loop()
+        # Scoring and forming the results happen together, so all of it counts as the search stage
+        with STAGE_SECONDS.labels("search").time():
+            return await loop.run_in_executor(self.executor, self.engine.search, vectors, top_k, self.per_paper,
+                                              filters)
+
+    async def warmup(self, vector: list[float]):
+        """Loads the shards, which reads every vector once to compute its norm, then runs a first search."""
+        # Imported here so that the Elasticsearch backend does not need NumPy search's dependencies loaded
+        from numpy_search import NumpySearch
+
+        loop = asyncio.get_running_loop()
+        self.engine = await loop.run_in_executor(self.executor, NumpySearch, self.directory)
+        await self.search(vector, 1)
+
+    async def close(self):
+        self.executor.shutdown()
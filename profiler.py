@@ -0,0 +1,135 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+# Quantities counted by every stage, reported as rates in the summary
+COUNTS = ("papers", "sentences", "documents", "bytes")
+
+
+class Profiler:
+    """Records the time spent in each stage of an ingest run and what each stage got through.
+
+    Stages run on several threads at once, such as concurrent CrossRef fetches and bulk requests, so their busy
+    times can add up to more than the wall-clock time of the run. Rates are per busy second of the stage.
+
+    Parameters
+    ----------
+    trace_path : str, optional
+        File to write a trace of every timed call to, in the Chrome trace event format. It can be opened in
+        Perfetto or chrome://tracing, and its "summary" holds the per-stage totals for comparing runs.
+    enabled : bool
+        Whether to record anything. A disabled profiler costs next to nothing.
+    """
+
+    def __init__(self, trace_path: str = None, enabled: bool = True):
+        self.enabled = enabled
+        self.stages = {}  # Stage name -> {"calls", "seconds" and every count in COUNTS}
+        self._start = time.perf_counter()
+        self._started_at = time.time()
+        self._lock = threading.Lock()
+        self._trace = None
+        self._first_event = True
+        if enabled and trace_path:
+            self._trace = open(trace_path, 'w', encoding='UTF-8')
+            self._trace.write('{"traceEvents": [\n')
+
+    @contextmanager
+    def stage(self, name: str, **counts: int) -> Iterator[dict[str, int]]:
+        """Times a block of work as part of a stage.
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage.
+        **counts : int
+            Starting values of the quantities in COUNTS the block processes.
+
+        Yields
+        ------
+        dict of str to int
+            The counts, which the block can change once it knows them, for example the number of sentences.
+        """
+        if not self.enabled:
+            yield dict(counts)
+            return
+
+        record = dict(counts)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            self.add(name, start, time.perf_counter() - start, **record)
+
+    def add(self, name: str, start: float, seconds: float, **counts: int):
+        """Records a call to a stage that was timed elsewhere.
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage.
+        start : float
+            time.perf_counter() when the call started.
+        seconds : float
+            Duration of the call.
+        **counts : int
+            Quantities in COUNTS the call processed.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            totals = self.stages.setdefault(name, dict(calls=0, seconds=0.0, **{c: 0 for c in COUNTS}))
+            totals["calls"] += 1
+            totals["seconds"] += seconds
+            for count, value in counts.items():
+                totals[count] += value
+
+            if self._trace is not None:
+                event = {"name": name, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                         "ts": round((start - self._start) * 1e6), "dur": round(seconds * 1e6), "args": counts}
+                self._trace.write(("" if self._first_event else ",\n") + json.dumps(event))
+                self._first_event = False
+
+    def summary(self) -> dict[str]:
+        """Gets the totals and rates of every stage.
+
+        Returns
+        -------
+        dict of str
+            Wall-clock seconds of the run so far and, for every stage, its calls, busy seconds, share of the wall
+            clock, counts and counts per busy second.
+        """
+        wall = time.perf_counter() - self._start
+        with self._lock:
+            stages = {}
+            for name, totals in self.stages.items():
+                seconds = totals["seconds"]
+                stages[name] = dict(totals, share=seconds / wall if wall else 0.0,
+                                    **{f"{c}_per_second": totals[c] / seconds if seconds else 0.0 for c in COUNTS})
+        return {"started": self._started_at, "wall_seconds": wall, "stages": stages}
+
+    def format_summary(self) -> str:
+        """Formats the summary as a table of one row per stage."""
+        summary = self.summary()
+        header = f"{'stage':<12}{'calls':>10}{'busy s':>10}{'% wall':>8}{'papers/s':>11}{'sentences/s':>13}" \
+                 f"{'docs/s':>10}{'MB/s':>9}"
+        lines = [f"Ingest profile, {summary['wall_seconds']:.1f} s wall clock", header, "-" * len(header)]
+        for name, s in summary["stages"].items():
+            rates = [f"{s[f'{c}_per_second']:.1f}" if s[c] else "-" for c in ("papers", "sentences", "documents")]
+            mb = f"{s['bytes_per_second'] / 1024 ** 2:.2f}" if s["bytes"] else "-"
+            lines.append(f"{name:<12}{s['calls']:>10}{s['seconds']:>10.1f}{s['share'] * 100:>7.0f}%"
+                         f"{rates[0]:>11}{rates[1]:>13}{rates[2]:>10}{mb:>9}")
+        return "\n".join(lines)
+
+    def close(self):
+        """Finishes the trace file, adding the summary to it."""
+        if self._trace is None:
+            return
+        with self._lock:
+            trace, self._trace = self._trace, None
+        trace.write('\n], "displayTimeUnit": "ms", "summary": ')
+        json.dump(self.summary(), trace)
+        trace.write("}\n")
+        trace.close()
@@ -0,0 +1,125 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+class CacheMiss(Exception):
+    """Raised in replay-only mode when a response was never cached."""
+
+
+class ResponseCache:
+    """Content-addressed on-disk cache of CrossRef API responses.
+
+    Each response is stored gzipped under the SHA-256 of its full URL, which includes the page cursor. Because
+    every cached page holds the cursor of the page after it, a cached harvest can be replayed page by page.
+
+    Parameters
+    ----------
+    directory : str
+        Directory the cache lives in. Created if missing.
+    ttl : float
+        Seconds a response stays fresh. Stale responses are fetched again unless replaying.
+    max_bytes : int
+        Maximum total size of the cache on disk. Least recently used responses are evicted past this.
+    replay : bool
+        Whether to serve only from the cache. Stale responses are still used and a missing one raises CacheMiss
+        instead of going to the network.
+    """
+
+    def __init__(self, directory: str = "crossref_cache", ttl: float = 7 * 24 * 3600,
+                 max_bytes: int = 2 * 1024 ** 3, replay: bool = False):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.replay = replay
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self._size = sum(os.path.getsize(p) for p in self._files())
+
+    def _path(self, url: str) -> str:
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, key[:2], key + ".json.gz")
+
+    def _files(self) -> list[str]:
+        return [os.path.join(root, name) for root, _, names in os.walk(self.directory)
+                for name in names if name.endswith(".json.gz")]
+
+    def get(self, url: str) -> dict[str] | None:
+        """Looks up the cached response for a URL.
+
+        Parameters
+        ----------
+        url : str
+            Full URL of the request, including its cursor.
+
+        Returns
+        -------
+        dict of str or None
+            The cached "message" object, or None if it is missing or stale.
+        """
+        path = self._path(url)
+        try:
+            stat = os.stat(path)
+            if not self.replay and time.time() - stat.st_mtime > self.ttl:
+                return None
+            with gzip.open(path, "rt", encoding="utf-8") as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            entry = None
+
+        if entry is None or entry["url"] != url:
+            if self.replay:
+                raise CacheMiss(url)
+            return None
+
+        # Mark as recently used for eviction without touching its age for the TTL. Another thread may have evicted
+        # it since it was read
+        try:
+            os.utime(path, (time.time(), stat.st_mtime))
+        except OSError:
+            pass
+        return entry["message"]
+
+    def put(self, url: str, message: dict[str]):
+        """Stores the response for a URL, evicting old responses if the cache is over its size.
+
+        Parameters
+        ----------
+        url : str
+            Full URL of the request, including its cursor.
+        message : dict of str
+            The "message" object of the response.
+        """
+        path = self._path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write then rename so that concurrent readers never see a partial file
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp, "wt", encoding="utf-8") as file:
+            json.dump({"url": url, "message": message}, file)
+
+        with self._lock:
+            if os.path.exists(path):
+                self._size -= os.path.getsize(path)
+            os.replace(tmp, path)
+            self._size += os.path.getsize(path)
+
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Drop least recently used responses until comfortably under the limit
+        files = sorted(self._files(), key=lambda p: os.stat(p).st_atime)
+        for path in files:
+            if self._size <= self.max_bytes * 0.9:
+                break
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+                self._size -= size
+            except OSError:
+                pass
@@ -0,0 +1,187 @@
+import json
+import os
+from typing import Iterator
+
+import numpy as np
+
+# Fixed size of the .npy header of a shard, so that it can be rewritten with the final shape once the shard is full
+_HEADER_BYTES = 128
+
+
+def _npy_header(dtype: np.dtype, rows: int, dims: int) -> bytes:
+    # Version 1.0 .npy header, padded with spaces to exactly _HEADER_BYTES
+    description = "{{'descr': '{}', 'fortran_order': False, 'shape': ({}, {}), }}".format(dtype.str, rows, dims)
+    header = description.ljust(_HEADER_BYTES - 10 - 1) + "\n"
+    return b"\x93NUMPY\x01\x00" + len(header).to_bytes(2, "little") + header.encode("latin1")
+
+
+class ShardWriter:
+    """Writes documents to a directory of append-only vector shards with JSON Lines sidecars.
+
+    Each shard is made of three files sharing a number:
+
+    - vectors-NNNNN.npy holds one row per sentence and can be memory-mapped with np.load(..., mmap_mode="r").
+    - sentences-NNNNN.jsonl holds the DOI and title-and-sentence of every row, in row order.
+    - papers-NNNNN.jsonl holds the metadata of every paper with the range of rows of its sentences.
+
+    manifest.json lists the finished shards. Documents are streamed to disk as they are written, so memory use
+    does not grow with the corpus. A shard left unfinished by a crash is not in the manifest and is ignored.
+
+    Parameters
+    ----------
+    directory : str
+        Directory to write the shards to. Created if missing. Shards already listed in its manifest are kept and
+        new ones are added after them.
+    dtype : str
+        "float16" or "float32". float16 halves the size with no noticeable effect on cosine similarity.
+    shard_rows : int
+        Number of sentence rows after which a new shard is started. A paper is never split across shards.
+    dims : int
+        Length of the vectors.
+    """
+
+    def __init__(self, directory: str, dtype: str = "float16", shard_rows: int = 1_000_000, dims: int = 384):
+        self.directory = directory
+        self.dtype = np.dtype(dtype)
+        self.shard_rows = shard_rows
+        self.dims = dims
+
+        os.makedirs(directory, exist_ok=True)
+        self.manifest = read_manifest(directory) if os.path.exists(os.path.join(directory, "manifest.json")) \
+            else {"dims": dims, "dtype": self.dtype.name, "shards": []}
+        if self.manifest["dims"] != dims or self.manifest["dtype"] != self.dtype.name:
+            raise ValueError(f"{directory} holds {self.manifest['dtype']} vectors of {self.manifest['dims']} "
+                             f"dimensions, not {self.dtype.name} of {dims}")
+        self._files = None
+
+    def _open(self):
+        name = "{:05d}".format(len(self.manifest["shards"]))
+        self._name = name
+        self._rows = 0
+        self._papers = 0
+        self._files = {
+            "vectors": open(os.path.join(self.directory, f"vectors-{name}.npy"), 'wb'),
+            "sentences": open(os.path.join(self.directory, f"sentences-{name}.jsonl"), 'w', encoding='UTF-8'),
+            "papers": open(os.path.join(self.directory, f"papers-{name}.jsonl"), 'w', encoding='UTF-8'),
+        }
+        self._files["vectors"].write(_npy_header(self.dtype, 0, self.dims))
+
+    def _finish(self):
+        # Rewrite the header with the final number of rows and add the shard to the manifest
+        vectors = self._files["vectors"]
+        vectors.seek(0)
+        vectors.write(_npy_header(self.dtype, self._rows, self.dims))
+        for file in self._files.values():
+            file.close()
+        self._files = None
+
+        self.manifest["shards"].append({"name": self._name, "rows": self._rows, "papers": self._papers})
+        tmp = os.path.join(self.directory, "manifest.json.tmp")
+        with open(tmp, 'w', encoding='UTF-8') as file:
+            json.dump(self.manifest, file, indent=2)
+        os.replace(tmp, os.path.join(self.directory, "manifest.json"))
+
+    def write(self, doc: dict[str]):
+        """Appends a document as yielded by get_documents.
+
+        Parameters
+        ----------
+        doc : dict of str
+            Document of metadata and vectors of one paper.
+        """
+        embedded = doc["embedded_paper"]
+        if self._files is not None and self._rows and self._rows + len(embedded) > self.shard_rows:
+            self._finish()
+        if self._files is None:
+            self._open()
+
+        doi = doc["metadata"]["DOI"]
+        if embedded:
+            vectors = np.asarray([e["vector"] for e in embedded], dtype=self.dtype)
+            self._files["vectors"].write(vectors.tobytes())
+        for e in embedded:
+            self._files["sentences"].write(json.dumps({"doi": doi, "title-and-sentence": e["title-and-sentence"]})
+                                           + "\n")
+
+        self._files["papers"].write(json.dumps({"metadata": doc["metadata"], "start": self._rows,
+                                                "end": self._rows + len(embedded)}) + "\n")
+        self._rows += len(embedded)
+        self._papers += 1
+
+    def close(self):
+        """Finishes the current shard."""
+        if self._files is not None:
+            self._finish()
+
+    def __enter__(self) -> "ShardWriter":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_manifest(directory: str) -> dict[str]:
+    """Reads the manifest of a shard directory.
+
+    Parameters
+    ----------
+    directory : str
+        Directory written by ShardWriter.
+
+    Returns
+    -------
+    dict of str
+        Length and type of the vectors, and the name, number of rows and number of papers of every shard.
+    """
+    with open(os.path.join(directory, "manifest.json"), 'r', encoding='UTF-8') as file:
+        return json.load(file)
+
+
+def load_vectors(directory: str, name: str) -> np.ndarray:
+    """Memory-maps the vectors of one shard.
+
+    Parameters
+    ----------
+    directory : str
+        Directory written by ShardWriter.
+    name : str
+        Name of the shard as listed in the manifest.
+
+    Returns
+    -------
+    np.ndarray
+        Read-only array of one row per sentence.
+    """
+    return np.load(os.path.join(directory, f"vectors-{name}.npy"), mmap_mode="r")
+
+
+def read_jsonl(directory: str, kind: str, name: str) -> Iterator[dict[str]]:
+    """Streams the lines of one shard's "sentences" or "papers" sidecar."""
+    with open(os.path.join(directory, f"{kind}-{name}.jsonl"), 'r', encoding='UTF-8') as file:
+        for line in file:
+            yield json.loads(line)
+
+
+def read_documents(directory: str) -> Iterator[dict[str]]:
+    """Streams documents back out of a shard directory in the form yielded by get_documents.
+
+    Parameters
+    ----------
+    directory : str
+        Directory written by ShardWriter.
+
+    Yields
+    ------
+    dict of str
+        Document of metadata and vectors for next paper. Vectors are float32 lists whatever the stored type.
+    """
+    for shard in read_manifest(directory)["shards"]:
+        vectors = load_vectors(directory, shard["name"])
+        sentences = read_jsonl(directory, "sentences", shard["name"])
+        for paper in read_jsonl(directory, "papers", shard["name"]):
+            rows = vectors[paper["start"]:paper["end"]].astype(np.float32).tolist()
+            yield {
+                "metadata": paper["metadata"],
+                "embedded_paper": [{"vector": v, "title-and-sentence": next(sentences)["title-and-sentence"]}
+                                   for v in rows]
+            }
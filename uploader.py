@@ -1,60 +1,399 @@
+import argparse
+import datetime
 import json
 import requests
 import os
 import numpy as np
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, NotFoundError, helpers
 from tqdm import tqdm
 import collect_documents as cdocs
+from bulk_indexer import bulk_index
+from checkpoint import Checkpoint
+from doi_set import DoiSet
+from embedding_pool import EmbeddingPool
+from profiler import Profiler
+from response_cache import ResponseCache
+from shards import ShardWriter, read_documents
 
-# Get environment variables.
-with open('.env', 'r') as f:
-    for line in f:
-        if line.startswith('ELASTIC_PASSWORD='):
-            elastic_password = line.strip().split('=')[1]
-            break
-
-# Configure Elasticsearch connection with basic authentication (default user, password).
-es = Elasticsearch(
-    "http://localhost:9200",
-    basic_auth=("elastic", elastic_password)
-)
-
-# Check if Elasticsearch is running.
-try:
-    es.info()
-    print("Successfully connected to Elasticsearch")
-except Exception as e:
-    print(f"Unable to connect to Elasticsearch: {e}")
-    exit(1)
-
-index_name = "research_papers"
-# Create index if it doesn't exist.
-if not es.indices.exists(index=index_name):
-    es.indices.create(index=index_name, body=cdocs.elasticsearch_mappings())
-    print("Created 'research_papers' index.")
-else:
-    doc_count = es.cat.count(index=index_name, format="json")[0]['count']
-    print(f"Number of documents in index {index_name}: {doc_count}.")
-
-# Gather documents.
-print("Gathering documents...")
-docs = cdocs.get_documents("food", 1000, 100, do_print=True)
-
-# Upload data to Elasticsearch.
-print("Uploading data to Elasticsearch...")
-bulk_data = []
-for doc in tqdm(docs, desc="Indexing documents"):
-    # Prepare bulk data for Elasticsearch.
-    bulk_data.append({"index": {"_index": index_name}})
-    bulk_data.append(doc)
-
-    # Submit in batches of 200 documents to avoid losing too much progress.
-    if len(bulk_data) >= 200:
-        es.bulk(body=bulk_data)
-        bulk_data = []
-
-# Submit remaining data.
-if bulk_data:
-    es.bulk(body=bulk_data)
-
-print("Complete! Data successfully uploaded to Elasticsearch.")
+# Command line options.
+parser = argparse.ArgumentParser(description="Collect papers from CrossRef and upload them to Elasticsearch.")
+parser.add_argument("--topics", nargs="+", default=["food"],
+                    help="Words or phrases to query CrossRef for journals with, one per topic. Every paper is tagged "
+                         "with the topics of its journal.")
+parser.add_argument("--topics-file", metavar="FILE",
+                    help="File with one topic per line, used instead of --topics. Blank lines and lines starting "
+                         "with # are ignored.")
+parser.add_argument("--min-abstracts", type=int, default=1000,
+                    help="Minimum number of abstracts a journal needs to be collected.")
+parser.add_argument("--min-cited", type=int, default=100,
+                    help="Minimum number of citations a paper needs to be collected.")
+parser.add_argument("--cache-dir", default="crossref_cache",
+                    help="Directory of the on-disk CrossRef response cache.")
+parser.add_argument("--cache-ttl", type=float, default=7 * 24,
+                    help="Hours a cached CrossRef response stays fresh.")
+parser.add_argument("--cache-size", type=float, default=2,
+                    help="Maximum size of the response cache in GiB.")
+parser.add_argument("--no-cache", action="store_true",
+                    help="Always fetch from CrossRef and do not cache responses.")
+parser.add_argument("--replay", action="store_true",
+                    help="Serve CrossRef responses only from the cache, without any network requests.")
+parser.add_argument("--from-shards", metavar="DIR",
+                    help="Upload documents from vector shards written earlier instead of harvesting and embedding.")
+parser.add_argument("--export-shards", metavar="DIR",
+                    help="Also write every harvested document to vector shards in this directory.")
+parser.add_argument("--checkpoint", default="ingest_checkpoint.json",
+                    help="File that ingest progress is saved to and resumed from.")
+parser.add_argument("--restart", action="store_true",
+                    help="Ignore any saved checkpoint and start the harvest from the beginning.")
+parser.add_argument("--refresh", action="store_true",
+                    help="Only harvest papers CrossRef added or updated since the newest index date recorded by "
+                         "the last completed run, and update them in place.")
+parser.add_argument("--refresh-state", default="refresh_state.json",
+                    help="File the newest CrossRef index date of the last completed run is recorded in.")
+parser.add_argument("--from-index-date", metavar="YYYY-MM-DD",
+                    help="Only harvest papers CrossRef added or updated on or after this date. Overrides --refresh.")
+parser.add_argument("--bulk-docs", type=int, default=500,
+                    help="Maximum number of documents per bulk request.")
+parser.add_argument("--bulk-mb", type=float, default=10,
+                    help="Maximum size of a bulk request in MiB.")
+parser.add_argument("--bulk-workers", type=int, default=4,
+                    help="Number of bulk requests sent concurrently.")
+parser.add_argument("--bulk-retries", type=int, default=3,
+                    help="Number of times documents rejected by Elasticsearch are retried.")
+parser.add_argument("--layout", default="nested", choices=["nested", "flat"],
+                    help="nested: one document per paper with its sentences nested inside. "
+                         "flat: one document per sentence, with paper metadata in a separate index joined by DOI.")
+parser.add_argument("--index-type", default="int8_hnsw", choices=cdocs.VECTOR_INDEX_TYPES,
+                    help="How sentence vectors are indexed when creating the index.")
+parser.add_argument("--hnsw-m", type=int, default=16,
+                    help="Neighbors per vector in the HNSW graph when creating the index.")
+parser.add_argument("--hnsw-ef-construction", type=int, default=100,
+                    help="Candidates considered per vector while building the HNSW graph when creating the index.")
+parser.add_argument("--failures-log", default="failed_documents.jsonl",
+                    help="File that documents which could not be indexed are reported to.")
+parser.add_argument("--profile", action="store_true",
+                    help="Print the time spent and throughput of every ingest stage at the end of the run.")
+parser.add_argument("--profile-trace", metavar="FILE",
+                    help="Write a trace of every timed call with the per-stage totals to this file, in the Chrome "
+                         "trace event format. Implies --profile.")
+parser.add_argument("--embed-workers", type=int, default=0,
+                    help="Number of worker processes embedding sentences, each with its own copy of the model. "
+                         "0 embeds in this process.")
+parser.add_argument("--embed-threads", type=int,
+                    help="Math library threads of each embedding worker. Defaults to the cores divided by workers.")
+parser.add_argument("--pin-cores", action="store_true",
+                    help="Bind each embedding worker to its own block of --embed-threads cores. Linux only.")
+parser.add_argument("--sentence-processes", type=int, default=1,
+                    help="Number of processes splitting abstracts into sentences. More than one is best combined "
+                         "with --embed-workers.")
+
+# Embedding workers are separate processes that import this script, so the run only happens in the main one.
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    topics = args.topics
+    if args.topics_file:
+        with open(args.topics_file, 'r', encoding='UTF-8') as f:
+            topics = [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+    # Topics are matched exactly when searching, so each is kept once.
+    topics = list(dict.fromkeys(topics))
+
+    # Get environment variables.
+    with open('.env', 'r') as f:
+        for line in f:
+            if line.startswith('ELASTIC_PASSWORD='):
+                elastic_password = line.strip().split('=')[1]
+                break
+
+    # Configure Elasticsearch connection with basic authentication (default user, password).
+    es = Elasticsearch(
+        "http://localhost:9200",
+        basic_auth=("elastic", elastic_password)
+    )
+
+    # Check if Elasticsearch is running.
+    try:
+        es.info()
+        print("Successfully connected to Elasticsearch")
+    except Exception as e:
+        print(f"Unable to connect to Elasticsearch: {e}")
+        exit(1)
+
+    index_name = "research_papers"
+    # Indices of the flat layout.
+    sentences_index = "research_sentences"
+    papers_index = "research_paper_metadata"
+
+    if args.layout == "nested":
+        indices = {index_name: cdocs.elasticsearch_mappings(args.index_type, args.hnsw_m, args.hnsw_ef_construction)}
+        # Index holding one document per paper, used to find papers that are already indexed.
+        doi_index = index_name
+    else:
+        indices = {sentences_index: cdocs.sentence_mappings(args.index_type, args.hnsw_m, args.hnsw_ef_construction),
+                   papers_index: cdocs.paper_mappings()}
+        doi_index = papers_index
+
+    # Create indices if they don't exist.
+    for name, mappings in indices.items():
+        if not es.indices.exists(index=name):
+            es.indices.create(index=name, body=mappings)
+            print(f"Created '{name}' index.")
+        else:
+            doc_count = es.cat.count(index=name, format="json")[0]['count']
+            print(f"Number of documents in index {name}: {doc_count}.")
+            # Indices created before papers were tagged with topics get the field added.
+            es.indices.put_mapping(index=name, properties={"metadata": {"properties": {"topics": {"type": "keyword"}}}})
+
+    # Load progress of an interrupted run.
+    if args.restart and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+    checkpoint = Checkpoint.load(args.checkpoint)
+    if checkpoint.indexed:
+        print(f"Resuming from checkpoint: {len(checkpoint.done_journals)} journals done, "
+              f"{len(checkpoint.indexed)} papers indexed.")
+
+    # Day the run began, which a resumed run keeps, since journals paged before the interruption have not been
+    # checked for changes since. Dates are in UTC, as CrossRef's are.
+    if checkpoint.started is None:
+        checkpoint.started = datetime.datetime.now(datetime.timezone.utc).date().isoformat()
+    started = datetime.date.fromisoformat(checkpoint.started)
+
+    # Day to harvest changes from in an incremental refresh.
+    from_index_date = None if args.from_shards else args.from_index_date
+    if args.refresh and not args.from_shards and not from_index_date:
+        if os.path.exists(args.refresh_state):
+            with open(args.refresh_state, 'r', encoding='UTF-8') as f:
+                from_index_date = json.load(f)["newest_indexed"]
+        else:
+            print(f"No {args.refresh_state} from an earlier run, harvesting everything.")
+    if from_index_date:
+        print(f"Refreshing papers indexed by CrossRef since {from_index_date}.")
+
+    # DOIs seen in this run. Papers found under an earlier journal are skipped before being parsed or embedded.
+    # Kept compact since it can hold every DOI in the index.
+    seen = DoiSet()
+    # DOIs and fingerprints of the title and abstract of every indexed paper. A paper harvested again, because it
+    # matches another topic or because CrossRef updated it, most often just its citation count, is only parsed and
+    # embedded again if its text changed. Otherwise its metadata is updated, adding any new topics.
+    indexed = DoiSet()
+    known_texts = DoiSet()
+    for hit in helpers.scan(es, index=doi_index, _source=["metadata.DOI", "metadata.title", "metadata.abstract"]):
+        metadata = hit["_source"].get("metadata", {})
+        if metadata.get("DOI"):
+            indexed.add(metadata["DOI"])
+            known_texts.add(cdocs.text_fingerprint(metadata))
+            # Uploading vector shards skips papers that are already indexed. So does any run for papers of nested
+            # indices built with generated IDs, which cannot be updated by DOI.
+            if args.from_shards or hit["_id"] != metadata["DOI"]:
+                seen.add(metadata["DOI"])
+    print(f"{len(indexed)} papers already indexed, embedded again only if their title or abstract changed.")
+
+    # Set up the CrossRef response cache.
+    cache = None
+    if not args.no_cache:
+        cache = ResponseCache(args.cache_dir, ttl=args.cache_ttl * 3600,
+                              max_bytes=int(args.cache_size * 1024 ** 3), replay=args.replay)
+
+    # Time spent in every stage of the run.
+    profiler = Profiler(args.profile_trace, enabled=args.profile or bool(args.profile_trace))
+
+    # Worker processes to embed sentences in. The pool starts them now, so the models load while the first pages are
+    # fetched.
+    pool = None
+    if args.embed_workers > 0 and not args.from_shards:
+        pool = EmbeddingPool(args.embed_workers, args.embed_threads, args.pin_cores)
+        print(f"Embedding in {pool.workers} worker processes with {pool.threads} threads each.")
+
+    # Gather documents.
+    print(f"Gathering documents on {', '.join(topics)}...")
+    if args.from_shards:
+        # Vectors were embedded when the shards were written, so only the upload is left.
+        docs = (doc for doc in read_documents(args.from_shards)
+                if not checkpoint.is_indexed(doc["metadata"]["DOI"]) and seen.add(doc["metadata"]["DOI"]))
+    else:
+        docs = cdocs.get_documents(topics, args.min_abstracts, args.min_cited, do_print=True, cache=cache,
+                                   checkpoint=checkpoint, seen=seen, from_index_date=from_index_date,
+                                   profiler=profiler, pool=pool, sentence_processes=args.sentence_processes,
+                                   known_texts=known_texts)
+
+    # Newest CrossRef index date of the harvested papers, which the next refresh starts from.
+    newest_indexed = None
+
+    def track_indexed(docs):
+        global newest_indexed
+        for doc in docs:
+            indexed = doc["metadata"].get("indexed") or {}
+            if "year" in indexed:
+                date = datetime.date(indexed["year"], indexed.get("month", 1), indexed.get("day", 1))
+                if newest_indexed is None or date > newest_indexed:
+                    newest_indexed = date
+            yield doc
+
+    if not args.from_shards:
+        docs = track_indexed(docs)
+
+    shard_writer = None
+    if args.export_shards and not args.from_shards:
+        shard_writer = ShardWriter(args.export_shards)
+
+        def export(docs):
+            for doc in docs:
+                # Papers whose text did not change in a refresh have no vectors to export.
+                if "embedded_paper" in doc:
+                    shard_writer.write(doc)
+                yield doc
+
+        docs = export(docs)
+
+    # Number of bulk items of each paper that have not come back yet, and papers with an item that failed.
+    remaining = {}
+    failed_papers = set()
+
+    # Replaces the metadata of an indexed paper with the harvested one, keeping the topics it had. The metadata is
+    # params.metadata, or for sentences of the flat layout params.papers[doi].
+    merge_metadata = """
+        def metadata = new HashMap(params.containsKey('papers') ? params.papers[ctx._source.doi] : params.metadata);
+        def old = ctx._source.metadata;
+        def topics = new ArrayList(old == null || old.topics == null ? [] : old.topics);
+        for (topic in metadata.topics) {
+            if (!topics.contains(topic)) {
+                topics.add(topic);
+            }
+        }
+        metadata.topics = topics;
+        ctx._source.metadata = metadata;
+    """
+
+    def indexed_topics(doi):
+        # Topics an indexed paper already has, so that embedding it again keeps them.
+        try:
+            hit = es.get(index=doi_index, id=doi, source_includes=["metadata.topics"])
+        except NotFoundError:
+            return []
+        return hit["_source"].get("metadata", {}).get("topics") or []
+
+    # Filterable metadata of unchanged papers in the flat layout, to copy into their sentences.
+    sentence_updates = {}
+    # Number of sentences of every indexed paper embedded again in the flat layout. Sentences of its earlier version
+    # at or past that position are no longer in the abstract.
+    sentence_counts = {}
+
+    def delete_stale_sentences():
+        # Delete the trailing sentences of earlier versions, many papers per request. New sentences are only
+        # written below each paper's count, so this can run while they are still being uploaded.
+        if sentence_counts:
+            stale = [{"bool": {"filter": [{"term": {"doi": doi}}, {"range": {"position": {"gte": count}}}]}}
+                     for doi, count in sentence_counts.items()]
+            es.delete_by_query(index=sentences_index, query={"bool": {"should": stale, "minimum_should_match": 1}},
+                               conflicts="proceed", refresh=False)
+            sentence_counts.clear()
+
+    def update_sentences():
+        # Copy new metadata into the sentences of unchanged papers, many papers per request.
+        if sentence_updates:
+            es.update_by_query(index=sentences_index, query={"terms": {"doi": list(sentence_updates)}},
+                               script={"source": merge_metadata, "params": {"papers": sentence_updates}},
+                               conflicts="proceed", refresh=False)
+            sentence_updates.clear()
+
+    def paper_actions(docs):
+        # Bulk actions for every paper in the chosen layout. All actions of a paper are counted before any is sent.
+        # Documents are keyed by DOI, so indexing a paper again replaces it instead of adding a duplicate.
+        for doc in docs:
+            doi = doc["metadata"]["DOI"]
+            if "embedded_paper" not in doc:
+                # Text unchanged since it was embedded, so only the metadata is updated.
+                index = index_name if args.layout == "nested" else papers_index
+                actions = [({"update": {"_index": index, "_id": doi}},
+                            {"script": {"source": merge_metadata, "params": {"metadata": doc["metadata"]}}})]
+                if args.layout == "flat":
+                    sentence_updates[doi] = cdocs.filterable_metadata(doc["metadata"])
+                    if len(sentence_updates) >= args.bulk_docs:
+                        update_sentences()
+                remaining[doi] = remaining.get(doi, 0) + len(actions)
+                yield from actions
+                continue
+
+            if doi in indexed:
+                # Text changed, so the paper is replaced, keeping the topics it was indexed under before.
+                topics = doc["metadata"]["topics"]
+                topics += [topic for topic in indexed_topics(doi) if topic not in topics]
+            if args.layout == "nested":
+                actions = [({"index": {"_index": index_name, "_id": doi}}, doc)]
+            else:
+                actions = [({"index": {"_index": papers_index, "_id": doi}}, {"metadata": doc["metadata"]})]
+                actions += [({"index": {"_index": sentences_index, "_id": f"{doi}/{sentence['position']}"}}, sentence)
+                            for sentence in cdocs.flatten_document(doc)]
+                if doi in indexed:
+                    # The paper may already be indexed with more sentences.
+                    sentence_counts[doi] = len(doc["embedded_paper"])
+                    if len(sentence_counts) >= args.bulk_docs:
+                        delete_stale_sentences()
+            remaining[doi] = remaining.get(doi, 0) + len(actions)
+            yield from actions
+        update_sentences()
+        delete_stale_sentences()
+
+    # Upload data to Elasticsearch.
+    # Documents are embedded on this thread while bulk requests are sent concurrently in the background.
+    print("Uploading data to Elasticsearch...")
+    results = bulk_index(es, paper_actions(docs), chunk_docs=args.bulk_docs,
+                         chunk_bytes=int(args.bulk_mb * 1024 ** 2), workers=args.bulk_workers,
+                         max_retries=args.bulk_retries, profiler=profiler)
+    failed = 0
+    progress = tqdm(desc="Indexing papers")
+    try:
+        with open(args.failures_log, 'w', encoding='UTF-8') as failures:
+            for ok, source, info in results:
+                if "script" in source:
+                    source = source["script"]["params"]  # Metadata update of an unchanged paper
+                doi = source["doi"] if "doi" in source else source["metadata"]["DOI"]
+                if not ok:
+                    failed += 1
+                    failed_papers.add(doi)
+                    failures.write(json.dumps({"doi": doi, "error": info.get("error"),
+                                               "status": info.get("status")}) + "\n")
+
+                remaining[doi] -= 1
+                if remaining[doi] == 0:
+                    del remaining[doi]
+                    # Only papers Elasticsearch fully accepted count as indexed in the checkpoint.
+                    if doi not in failed_papers:
+                        checkpoint.mark_indexed([doi])
+                    failed_papers.discard(doi)
+                    progress.update(1)
+                checkpoint.maybe_save()
+    finally:
+        progress.close()
+        # Stop the embedding workers, also when the run is interrupted.
+        if pool is not None:
+            pool.close()
+    if shard_writer is not None:
+        shard_writer.close()
+
+    if failed:
+        print(f"{failed} documents could not be indexed. See {args.failures_log}.")
+
+    if profiler.enabled:
+        print(profiler.format_summary())
+        profiler.close()
+        if args.profile_trace:
+            print(f"Trace written to {args.profile_trace}.")
+
+    # Keep the checkpoint only if some papers failed to index, so the next run retries them.
+    if checkpoint.has_pending():
+        checkpoint.save()
+        print(f"Some papers were not indexed. Run again to retry them from {args.checkpoint}.")
+    else:
+        if os.path.exists(args.checkpoint):
+            os.remove(args.checkpoint)
+        # Record where the next refresh starts, only once every harvested paper is indexed.
+        # CrossRef index dates are whole days and from-index-date includes the day, so the last day is fetched
+        # again. Dates after the start of the run are not trusted, since journals harvested early may have had
+        # papers indexed after they were paged through.
+        if newest_indexed is not None:
+            with open(args.refresh_state, 'w', encoding='UTF-8') as f:
+                json.dump({"newest_indexed": min(newest_indexed, started).isoformat()}, f)
+            print(f"Next --refresh starts from {min(newest_indexed, started).isoformat()}.")
+
+    print("Complete! Data successfully uploaded to Elasticsearch.")